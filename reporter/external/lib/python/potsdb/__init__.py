@@ -1,2 +1,3 @@
 __version__ = '1.0.3'
-from potsdb.client import Client
+from potsdb.client import Client, DedupIndex, BloomDedupIndex, TokenBucket
+from potsdb.spool import Spool
@@ -2,51 +2,171 @@ from __future__ import print_function
 import socket
 import threading
 import time
-import random
-import string
+import re
 import sys
+import math
+import struct
+import hashlib
+import collections
+
+from potsdb.spool import Spool
 try:
     import queue
 except ImportError:
     import Queue as queue
 
 MPS_LIMIT = 0  # Limit on metrics per second to send to OpenTSDB
+BATCH_BYTES = 8192  # Number of bytes of lines coalesced into one write
+TAG_CACHE_SIZE = 10000  # Number of tag sets with a cached tag string
+DEDUP_SIZE = 100000  # Number of recent data points checked for duplicates
 
-_last_timestamp = None
-_last_metrics = set()
-
-_valid_metric_chars = set(string.ascii_letters + string.digits + '-_./')
+_valid_metric_name = re.compile(r'[-_./a-zA-Z0-9]*\Z').match
 
 
 def _mksocket(host, port, q, done, stop):
-    """Returns a tcp socket to (host/port). Retries forever if connection fails"""
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.settimeout(2)
+    """Returns a tcp socket to (host/port). Retries until stop is set if connection fails"""
     attempt = 0
     while not stop.is_set():
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(2)
         try:
             s.connect((host, port))
             return s
         except Exception as ex:
+            s.close()
             # Simple exponential backoff: sleep for 1,2,4,8,16,30,30...
-            time.sleep(min(30, 2 ** attempt))
+            stop.wait(min(30, 2 ** attempt))
             attempt += 1
 
-def _push(host, port, q, done, mps, stop, test_mode):
-    """Worker thread. Connect to host/port, pull data from q until done is set"""
+class DedupIndex(object):
+    """Index of the (metric, timestamp, tags) keys of the data points sent,
+    for dropping duplicates. It keeps the max_size most recently seen keys,
+    and can be shared by clients in different threads."""
+
+    def __init__(self, max_size=DEDUP_SIZE):
+        self.max_size = max_size
+        self._keys = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, key):
+        """Return True if key is in the index, otherwise add it to the index"""
+        with self._lock:
+            if key in self._keys:
+                # move the key to the most recent end
+                del self._keys[key]
+                self._keys[key] = None
+                return True
+            self._keys[key] = None
+            if len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+            return False
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class BloomDedupIndex(object):
+    """Probabilistic DedupIndex in constant memory. Keys are added to a Bloom
+    filter sized for capacity keys at the given false positive rate; when it
+    is full it replaces the previous filter and a new one is started, so at
+    least the last capacity keys are remembered. A false positive drops a
+    data point that is not a duplicate."""
+
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        self.capacity = capacity
+        self.nbits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.nhashes = max(1, int(round(float(self.nbits) / capacity * math.log(2))))
+        self._current = bytearray((self.nbits + 7) // 8)
+        self._previous = bytearray(len(self._current))
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def _positions(self, key):
+        key = '%s %d %s' % key
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        h1, h2 = struct.unpack('<II', hashlib.md5(key).digest()[:8])
+        nbits = self.nbits
+        return [((h1 + i * h2) % nbits) for i in range(self.nhashes)]
+
+    def seen(self, key):
+        """Return True if key is (likely) in the index, otherwise add it to the index"""
+        positions = [(p >> 3, 1 << (p & 7)) for p in self._positions(key)]
+        with self._lock:
+            for bits in (self._current, self._previous):
+                for i, mask in positions:
+                    if not bits[i] & mask:
+                        break
+                else:
+                    return True
+            current = self._current
+            for i, mask in positions:
+                current[i] |= mask
+            self._count += 1
+            if self._count >= self.capacity:
+                self._previous = self._current
+                self._current = bytearray(len(self._previous))
+                self._count = 0
+            return False
+
+
+class TokenBucket(object):
+    """Rate limiter for rate data points per second on average, in bursts of
+    up to burst data points (by default rate, at least 1). It can be shared by
+    several worker threads."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = max(1, int(burst or rate))
+        self._tokens = float(self.burst)
+        self._time = time.time()
+        self._lock = threading.Lock()
+
+    def take(self, n=1, stop=None):
+        """Block until n (at most burst) tokens are available and take them,
+        or until the stop event is set"""
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens + (now - self._time) * self.rate)
+                self._time = now
+                if self._tokens >= n:
+                    self._tokens -= n
+                    return True
+                wait_time = (n - self._tokens) / self.rate
+            if stop is None:
+                time.sleep(wait_time)
+            elif stop.wait(wait_time):
+                return False
+
+
+def _drain(q, lines, size, max_bytes, max_lines=sys.maxsize):
+    """Move lines from q to the list of lines until they add up to max_bytes or
+    max_lines, or q is empty."""
+    while size < max_bytes and len(lines) < max_lines:
+        try:
+            line = q.get_nowait()
+        except queue.Empty:
+            break
+        lines.append(line)
+        size += len(line)
+    return lines
+
+def _push(host, port, q, done, bucket, stop, test_mode, lost):
+    """Worker thread. Connect to host/port, pull data from q until done is set.
+    The lines are sent at the rate of the bucket, if it is not None. The lost
+    event is set if the worker stops with lines taken from q but not sent."""
     sock = None
-    retry_line = None
-    while not ( stop.is_set() or ( done.is_set() and retry_line == None and q.empty()) ):
-        stime = time.time()
-
+    retry_buf = None
+    while not ( stop.is_set() or ( done.is_set() and retry_buf == None and q.empty()) ):
         if sock == None and not test_mode:
             sock = _mksocket(host, port, q, done, stop)
             if sock == None:
                 break
 
-        if retry_line:
-            line = retry_line
-            retry_line = None
+        if retry_buf:
+            buf = retry_buf
+            retry_buf = None
         else:
             try:
                 line = q.get(True, 1)  # blocking, with 1 second timeout
@@ -56,21 +176,60 @@ def _push(host, port, q, done, mps, stop, test_mode):
                 else:  # no items in queue, but parent might send more
                     continue
 
+            # write the lines waiting in the queue together with this line,
+            # as many as the rate limit allows at once
+            lines = [line]
+            if bucket is None:
+                _drain(q, lines, len(line), BATCH_BYTES)
+            else:
+                _drain(q, lines, len(line), BATCH_BYTES, bucket.burst)
+                if not bucket.take(len(lines), stop):
+                    # stopped while waiting for the rate limit, the lines are not sent
+                    retry_buf = ''.join(lines).encode('utf-8')
+                    break
+            buf = ''.join(lines).encode('utf-8')
+
         if not test_mode:
             try:
-                sock.sendall(line.encode('utf-8'))
+                sock.sendall(buf)
             except:
                 sock = None  # notify that we need to make a new socket at start of loop
-                retry_line = line  # can't really put back in q, so remember to retry this line
+                retry_buf = buf  # can't really put back in q, so remember to retry these lines
                 continue
 
-        etime = time.time() - stime  #time that actually elapsed
+    if retry_buf:
+        lost.set()  # stopped, or the reconnect failed, before the lines could be sent again
 
-        #Expected value of wait_time is 1/MPS_LIMIT, ie. MPS_LIMIT per second.
-        if mps > 0:
-            wait_time = (2.0 * random.random()) / (mps)
-            if wait_time > etime:  #if we should wait
-                time.sleep(wait_time - etime)  #then wait
+    if sock:
+        sock.close()
+
+def _push_spool(host, port, spool, done, bucket, stop, test_mode):
+    """Worker thread. Connect to host/port, send the lines in spool until done is
+    set and the spool is empty. Lines are acknowledged in the spool once sent."""
+    sock = None
+    while not ( stop.is_set() or ( done.is_set() and spool.empty() ) ):
+        if sock == None and not test_mode:
+            sock = _mksocket(host, port, None, done, stop)
+            if sock == None:
+                break
+
+        if bucket is None:
+            buf = spool.read(BATCH_BYTES, timeout=1)
+        else:
+            buf = spool.read(BATCH_BYTES, bucket.burst, timeout=1)
+        if buf is None:
+            continue
+        if bucket is not None and not bucket.take(buf.count(b'\n'), stop):
+            break  # stopped while waiting for the rate limit, the lines are left in the spool
+
+        if not test_mode:
+            try:
+                sock.sendall(buf)
+            except:
+                sock = None  # the lines are read again from the spool after reconnecting
+                continue
+
+        spool.ack()
 
     if sock:
         sock.close()
@@ -78,23 +237,56 @@ def _push(host, port, q, done, mps, stop, test_mode):
 
 class Client():
     def __init__(self, host, port=4242, qsize=100000, host_tag=True,
-                 mps=MPS_LIMIT, check_host=True, test_mode=False):
-        """Main tsdb client. Connect to host/port. Buffer up to qsize metrics"""
+                 mps=MPS_LIMIT, check_host=True, test_mode=False, dedup=True,
+                 burst=None, nconns=1, spool=None):
+        """Main tsdb client. Connect to host/port. Buffer up to qsize metrics
+
+        The metrics are sent by nconns worker threads, each with a connection
+        to host, which can also be a list of hosts the connections are spread
+        over. If mps > 0, all workers together send at most mps metrics per
+        second on average, in bursts of up to burst metrics.
+
+        Duplicated data points are dropped if dedup is True, using a DedupIndex
+        of the client. dedup can also be a DedupIndex or BloomDedupIndex, e.g.
+        shared by several clients, or False to send all data points.
+
+        If spool is given, as a Spool or the directory of one, the metrics are
+        buffered in the spool rather than in memory, and sent by one worker
+        thread, to the first host only; nconns and the other hosts are not used,
+        as the lines of the spool are read in order. Metrics not sent when the
+        client is stopped are sent by the next client on the spool."""
 
         self.q = queue.Queue(maxsize=qsize)
         self.done = threading.Event()
         self._stop = threading.Event()
-        self.host = host
+        self._lost = threading.Event()
+        if isinstance(host, (list, tuple)):
+            self.hosts = list(host)
+        else:
+            self.hosts = [host]
+        self.host = self.hosts[0]
         self.port = int(port)
         self.queued = 0
 
+        # metric names checked to be valid, and tag strings of the tag sets
+        self._valid_names = set()
+        self._tagvals = {}
+
+        if dedup is True:
+            self.dedup = DedupIndex()
+        elif dedup is False or dedup is None:
+            self.dedup = None
+        else:
+            self.dedup = dedup
+
         # Make initial check that the host is up, because once in the
         # background thread it will be silently ignored/retried
         if check_host == True:
-            temp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            temp_sock.settimeout(3)
-            temp_sock.connect((self.host, self.port))
-            temp_sock.close()
+            for h in self.hosts:
+                temp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                temp_sock.settimeout(3)
+                temp_sock.connect((h, self.port))
+                temp_sock.close()
 
         if host_tag == True:
             self.host_tag = socket.gethostname()
@@ -103,20 +295,45 @@ class Client():
         else:
             self.host_tag = None
 
-        self.t = threading.Thread(target=_push,
-                                  args=(host, self.port, self.q, self.done, mps, self._stop, test_mode))
-        #self.t.daemon = daemon
-        self.t.daemon = True
-        self.t.start()
+        self.bucket = None
+        if mps > 0:
+            self.bucket = TokenBucket(mps, burst)
+
+        self.spool = None
+        self._own_spool = False
+        if isinstance(spool, Spool):
+            self.spool = spool
+        elif spool:
+            self.spool = Spool(spool)
+            self._own_spool = True
+
+        self.threads = []
+        for i in range(max(1, nconns)):
+            if self.spool is not None:
+                t = threading.Thread(target=_push_spool,
+                                     args=(self.host, self.port, self.spool, self.done,
+                                           self.bucket, self._stop, test_mode))
+            else:
+                t = threading.Thread(target=_push,
+                                     args=(self.hosts[i % len(self.hosts)], self.port, self.q, self.done,
+                                           self.bucket, self._stop, test_mode, self._lost))
+            #t.daemon = daemon
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+            if self.spool is not None:
+                break  # the spool is read in order by one worker
+        self.t = self.threads[0]
 
     def log(self, name, val, **tags):
         """Log metric name with value val. You must include at least one tag as a kwarg"""
-        global _last_timestamp, _last_metrics
 
         # do not allow .log after closing
         assert not self.done.is_set(), "worker thread has been closed"
         # check if valid metric name
-        assert all(c in _valid_metric_chars for c in name), "invalid metric name " + name
+        if name not in self._valid_names:
+            assert _valid_metric_name(name), "invalid metric name " + name
+            self._valid_names.add(name)
 
         val = float(val)  #Duck type to float/int, if possible.
         if int(val) == val:
@@ -131,30 +348,37 @@ class Client():
         assert not self.done.is_set(), "tsdb object has been closed"
         assert tags != {}, "Need at least one tag"
 
-        tagvals = ' '.join(['%s=%s' % (k, v) for k, v in tags.items()])
+        # the tag string is formatted once per tag set
+        tagkey = frozenset(tags.items())
+        try:
+            tagvals = self._tagvals[tagkey]
+        except KeyError:
+            if len(self._tagvals) >= TAG_CACHE_SIZE:
+                self._tagvals.clear()
+            tagvals = self._tagvals[tagkey] = ' '.join(['%s=%s' % (k, v) for k, v in tags.items()])
 
         # OpenTSDB has major problems if you insert a data point with the same
-        # metric, timestamp and tags. So we keep a temporary set of what points
-        # we have sent for the last timestamp value. If we encounter a duplicate,
-        # it is dropped.
-        unique_str = "%s, %s, %s, %s, %s" % (name, timestamp, tagvals, self.host, self.port)
-        if timestamp == _last_timestamp or _last_timestamp == None:
-            if unique_str in _last_metrics:
-                return  # discard duplicate metrics
-            else:
-                _last_metrics.add(unique_str)
-        else:
-            _last_timestamp = timestamp
-            _last_metrics.clear()
+        # metric, timestamp and tags. So we keep an index of the points we have
+        # sent recently. If we encounter a duplicate, it is dropped.
+        if self.dedup is not None and self.dedup.seen((name, timestamp, tagvals)):
+            return  # discard duplicate metrics
 
         line = "put %s %d %s %s\n" % (name, timestamp, val, tagvals)
 
+        if self.spool is not None:
+            self.spool.append(line)
+            self.queued += 1
+            return line
+
         try:
             self.q.put(line, False)
             self.queued += 1
         except queue.Full:
             print("potsdb - Warning: dropping oldest metric because Queue is full. Size: %s" % self.q.qsize(), file=sys.stderr)
-            self.q.get()  #Drop the oldest metric to make room
+            try:
+                self.q.get_nowait()  #Drop the oldest metric to make room
+            except queue.Empty:
+                pass  # the worker thread has emptied the queue meanwhile
             self.q.put(line, False)
         return line # So we can get visibility on what was sent
 
@@ -164,12 +388,27 @@ class Client():
         """Close and clean up the connection"""
         self.done.set()
 
-    def wait(self):
-        """Close then block waiting for background thread to finish"""
+    def wait(self, timeout=None):
+        """Close then block waiting for background threads to finish, or stop
+        them after timeout seconds. Returns True if all metrics have been sent."""
         self.close()
-        while self.t.is_alive():
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while any(t.is_alive() for t in self.threads):
+            if timeout is not None and time.time() >= deadline:
+                self.stop()
+                for t in self.threads:
+                    t.join()
+                break
             time.sleep(0.05)
 
+        if self.spool is not None:
+            sent = self.spool.empty()
+            if self._own_spool:
+                self.spool.close()
+            return sent
+        return self.q.empty() and not self._lost.is_set()
+
     def stop(self):
         self._stop.set()
 
@@ -0,0 +1,212 @@
+from __future__ import print_function
+import os
+import sys
+import mmap
+import errno
+import fcntl
+import struct
+import threading
+
+SEGMENT_SIZE = 4 * 1024 * 1024  # Size in bytes of a spool segment file
+MAX_SEGMENTS = 64  # Number of segment files kept before the oldest is dropped
+
+_cursor = struct.Struct('<QQ')  # segment number and offset of the read cursor
+
+
+class Spool(object):
+    """Append-only spool of lines on disk, for the lines not yet sent to the TSD.
+
+    Lines are appended to memory-mapped segment files of segment_size bytes in
+    the directory path. A read cursor, also memory-mapped, is moved forward
+    only when the lines read are acknowledged, so the lines not sent before
+    the process exits are read again by the next Spool on the directory.
+    Segments are removed once they are read; if there are more than
+    max_segments, the oldest segment is dropped, lines unread or not.
+
+    The spool is used by one reader and any number of writer threads of one
+    process. The directory is locked against use by other processes."""
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE, max_segments=MAX_SEGMENTS):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_segments = max(2, max_segments)
+        self.dropped = 0
+
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        self._lockf = open(os.path.join(path, 'lock'), 'a')
+        try:
+            fcntl.flock(self._lockf, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self._lockf.close()
+            raise IOError("spool %s is in use by another process" % path)
+
+        self._cond = threading.Condition()
+        self._maps = {}
+        self._pending = 0
+        self._wseg = None
+
+        # the read cursor
+        cpath = os.path.join(path, 'cursor')
+        if not os.path.exists(cpath):
+            with open(cpath, 'wb') as f:
+                f.write(_cursor.pack(0, 0))
+        self._cursorf = open(cpath, 'r+b')
+        self._cursor = mmap.mmap(self._cursorf.fileno(), _cursor.size)
+        self._rseg, self._roff = _cursor.unpack_from(self._cursor)
+
+        # the segments, the last one is written to
+        self._segments = sorted(int(n[:-4]) for n in os.listdir(path) if n.endswith('.seg'))
+        if not self._segments:
+            self._segments = [self._rseg]
+            self._create(self._rseg)
+        self._wpos = self._recover(self._segments[-1])
+        self._wseg = self._segments[-1]
+
+        if self._rseg not in self._segments:
+            self._seek(self._segments[0], 0)
+
+    def _file(self, seg):
+        return os.path.join(self.path, '%010d.seg' % seg)
+
+    def _create(self, seg):
+        with open(self._file(seg), 'wb') as f:
+            f.truncate(self.segment_size)
+
+    def _map(self, seg):
+        try:
+            return self._maps[seg][1]
+        except KeyError:
+            f = open(self._file(seg), 'r+b')
+            m = mmap.mmap(f.fileno(), 0)
+            self._maps[seg] = (f, m)
+            return m
+
+    def _unmap(self, seg):
+        if seg in self._maps:
+            f, m = self._maps.pop(seg)
+            m.close()
+            f.close()
+
+    def _scan(self, seg):
+        """Offset of the end of the lines in the segment, the rest is zero-filled"""
+        m = self._map(seg)
+        end = m.find(b'\0')
+        if end < 0:
+            end = len(m)
+        return end
+
+    def _recover(self, seg):
+        """Offset of the end of the complete lines in the segment. A partial line
+        left by a writer killed while appending is zero-filled, not to have the
+        next line appended to it"""
+        m = self._map(seg)
+        end = self._scan(seg)
+        last = m.rfind(b'\n', 0, end) + 1
+        if last < end:
+            print("potsdb - Warning: dropping partial line at the end of spool segment %s" % self._file(seg), file=sys.stderr)
+            m[last:end] = b'\0' * (end - last)
+        return last
+
+    def _end(self, seg):
+        if seg == self._wseg:
+            return self._wpos
+        return self._scan(seg)
+
+    def _seek(self, seg, off):
+        self._rseg, self._roff = seg, off
+        _cursor.pack_into(self._cursor, 0, seg, off)
+
+    def _remove(self, seg):
+        self._unmap(seg)
+        self._segments.remove(seg)
+        os.remove(self._file(seg))
+
+    def append(self, line):
+        """Append a line (ending with a newline) to the spool"""
+        if not isinstance(line, bytes):
+            line = line.encode('utf-8')
+        if len(line) > self.segment_size:
+            raise ValueError("line longer than the spool segment size")
+
+        with self._cond:
+            if self._wpos + len(line) > self.segment_size:
+                self._wseg += 1
+                self._wpos = 0
+                self._create(self._wseg)
+                self._segments.append(self._wseg)
+                if len(self._segments) > self.max_segments:
+                    self._drop()
+            self._map(self._wseg)[self._wpos:self._wpos + len(line)] = line
+            self._wpos += len(line)
+            self._cond.notify()
+
+    def _drop(self):
+        seg = self._segments[0]
+        print("potsdb - Warning: dropping oldest spool segment because spool is full: %s" % self._file(seg), file=sys.stderr)
+        if seg == self._rseg:
+            self.dropped += self._map(seg)[self._roff:self._end(seg)].count(b'\n')
+            self._pending = 0
+            self._seek(self._segments[1], 0)
+        self._remove(seg)
+
+    def read(self, max_bytes, max_lines=sys.maxsize, timeout=None):
+        """Return the lines after the read cursor, up to max_bytes bytes (or the
+        first line, if longer) and max_lines lines, or None if there are no lines
+        within timeout seconds. The same lines are returned until ack is called."""
+        with self._cond:
+            while True:
+                end = self._end(self._rseg)
+                if self._roff < end:
+                    break
+                if self._rseg != self._wseg:
+                    # the segment has been read, continue with the next one
+                    seg = self._rseg
+                    self._seek(self._segments[self._segments.index(seg) + 1], 0)
+                    self._remove(seg)
+                    continue
+                if timeout is not None and timeout <= 0:
+                    return None
+                self._cond.wait(timeout)
+                if self._roff >= self._end(self._rseg) and self._rseg == self._wseg:
+                    return None
+
+            m = self._map(self._rseg)
+            stop = min(end, self._roff + max_bytes)
+            stop = m.rfind(b'\n', self._roff, stop) + 1
+            if stop <= 0:
+                stop = m.find(b'\n', self._roff, end) + 1
+            data = m[self._roff:stop]
+            if data.count(b'\n') > max_lines:
+                pos = -1
+                for i in range(max_lines):
+                    pos = data.index(b'\n', pos + 1)
+                data = data[:pos + 1]
+            self._pending = len(data)
+            return data
+
+    def ack(self):
+        """Move the read cursor past the lines returned by the last read"""
+        with self._cond:
+            self._seek(self._rseg, self._roff + self._pending)
+            self._pending = 0
+
+    def empty(self):
+        """Return True if all lines in the spool have been read"""
+        with self._cond:
+            return self._rseg == self._wseg and self._roff >= self._wpos
+
+    def close(self):
+        """Write the spool to disk and release it"""
+        with self._cond:
+            for seg in list(self._maps):
+                self._maps[seg][1].flush()
+                self._unmap(seg)
+            self._cursor.flush()
+            self._cursor.close()
+            self._cursorf.close()
+            self._lockf.close()
@@ -4,6 +4,10 @@ import random
 import time
 import os
 import socket
+import threading
+import tempfile
+import shutil
+import struct
 
 from unittest import TestCase, main as unittest_main
 
@@ -15,6 +19,34 @@ def _get_client(**kwargs):
   my_kwargs.update(kwargs)
   return potsdb.Client(HOST, **my_kwargs)
 
+def _get_server(nconns=1):
+  # listens on a free port, and collects the data received on the first nconns connections
+  server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  server.bind(('127.0.0.1', 0))
+  server.listen(nconns)
+  received = []
+  def receive(conn, data):
+    while True:
+      d = conn.recv(65536)
+      if not d:
+        break
+      data.append(d)
+    conn.close()
+  def serve():
+    receivers = []
+    for x in range(nconns):
+      conn, addr = server.accept()
+      received.append([])
+      receivers.append(threading.Thread(target=receive, args=(conn, received[-1])))
+      receivers[-1].start()
+    for r in receivers:
+      r.join()
+    server.close()
+  t = threading.Thread(target=serve)
+  t.daemon = True
+  t.start()
+  return server.getsockname()[1], t, received
+
 class TestPotsDB(TestCase):
 
     def test_normal(self):
@@ -37,6 +69,132 @@ class TestPotsDB(TestCase):
         self.assertGreaterEqual(finished-started, 3)
         self.assertEqual(t.queued, 4)
 
+    def test_burst_mps(self):
+        t = _get_client(mps=10, burst=10)
+        started = time.time()
+        for x in range(20):
+            t.log('test.metric17', x, cheese='blue', timestamp=1234567890 + x)
+        t.wait()
+        finished = time.time()
+        self.assertGreaterEqual(finished-started, 0.9)
+        self.assertLess(finished-started, 2)
+        self.assertEqual(t.queued, 20)
+
+    def test_multiple_connections(self):
+        # lines are spread over the connections to the hosts
+        port, server, received = _get_server(nconns=2)
+        t = potsdb.Client(['127.0.0.1', 'localhost'], port=port, host_tag='tester', check_host=False, nconns=2)
+        self.assertEqual(len(t.threads), 2)
+        lines = [t.log('test.metric18', x, tag1='conn', timestamp=1234567890 + x) for x in range(1000)]
+        t.wait()
+        server.join(5)
+        self.assertEqual(len(received), 2)
+        sent = b''.join(b''.join(r) for r in received).decode('utf-8')
+        self.assertEqual(sorted(sent.splitlines(True)), sorted(lines))
+
+    def test_spool(self):
+        # lines not sent are kept in the spool for the next client
+        path = tempfile.mkdtemp()
+        try:
+            port, server, received = _get_server()
+            lines = []
+            t = potsdb.Client('127.0.0.1', port=1, host_tag='tester', check_host=False, spool=path)
+            lines += [t.log('test.metric19', x, tag1='spool', timestamp=1234567890 + x) for x in range(100)]
+            self.assertFalse(t.wait(timeout=0.5))
+            t = potsdb.Client('127.0.0.1', port=port, host_tag='tester', check_host=False, spool=path)
+            lines += [t.log('test.metric19', x, tag1='spool', timestamp=1234567990 + x) for x in range(100)]
+            self.assertTrue(t.wait(timeout=5))
+            server.join(5)
+            self.assertEqual(b''.join(received[0]), ''.join(lines).encode('utf-8'))
+        finally:
+            shutil.rmtree(path)
+
+    def test_spool_bounded(self):
+        path = tempfile.mkdtemp()
+        try:
+            spool = potsdb.Spool(path, segment_size=100, max_segments=3)
+            for x in range(100):
+                spool.append('line %05d\n' % x)
+            self.assertEqual(len([n for n in os.listdir(path) if n.endswith('.seg')]), 3)
+            data = b''
+            while not spool.empty():
+                data += spool.read(35, max_lines=2)
+                spool.ack()
+            self.assertEqual(data.splitlines()[-1], b'line 00099')
+            self.assertEqual(spool.dropped + len(data.splitlines()), 100)
+            self.assertEqual(len([n for n in os.listdir(path) if n.endswith('.seg')]), 1)
+            spool.close()
+        finally:
+            shutil.rmtree(path)
+
+    def test_spool_unacknowledged(self):
+        # lines read but not acknowledged are read again
+        path = tempfile.mkdtemp()
+        try:
+            spool = potsdb.Spool(path)
+            spool.append('line 1\n')
+            spool.append('line 2\n')
+            self.assertEqual(spool.read(100, max_lines=1), b'line 1\n')
+            spool.close()
+            spool = potsdb.Spool(path)
+            self.assertEqual(spool.read(100), b'line 1\nline 2\n')
+            spool.ack()
+            self.assertTrue(spool.empty())
+            self.assertEqual(spool.read(100, timeout=0), None)
+            spool.close()
+        finally:
+            shutil.rmtree(path)
+
+    def test_connection_reset(self):
+        # lines failing to be sent on a connection reset by the server are not reported as sent
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        port = server.getsockname()[1]
+        t = potsdb.Client('127.0.0.1', port=port, host_tag='tester', check_host=False)
+        conn, addr = server.accept()
+        time.sleep(0.2)  # the worker is connected
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        conn.close()  # reset the connection
+        server.close()  # and stop listening
+        time.sleep(0.2)
+        for x in range(100):
+            t.log('test.metric20', x, tag1='reset', timestamp=1234567890 + x)
+        # the lines are taken from the queue by the worker, which fails to send them
+        for i in range(50):
+            if t.q.empty():
+                break
+            time.sleep(0.1)
+        self.assertTrue(t.q.empty())
+        self.assertFalse(t.wait(timeout=3))
+
+    def test_spool_partial_line(self):
+        # a partial line left by a writer killed while appending is dropped
+        path = tempfile.mkdtemp()
+        try:
+            spool = potsdb.Spool(path, segment_size=100)
+            spool.append('line 1\n')
+            spool.close()
+            with open(os.path.join(path, '%010d.seg' % 0), 'r+b') as f:
+                f.seek(7)
+                f.write(b'line 2 par')
+            spool = potsdb.Spool(path, segment_size=100)
+            spool.append('line 3\n')
+            self.assertEqual(spool.read(100), b'line 1\nline 3\n')
+            spool.close()
+        finally:
+            shutil.rmtree(path)
+
+    def test_stop_rate_limited(self):
+        # lines waiting for the rate limit when the client is stopped are not sent
+        port, server, received = _get_server()
+        t = potsdb.Client('127.0.0.1', port=port, host_tag='tester', check_host=False, mps=1, burst=10)
+        for x in range(20):
+            t.log('test.metric21', x, tag1='rate', timestamp=1234567890 + x)
+        self.assertFalse(t.wait(timeout=2))
+        server.join(5)
+        self.assertEqual(b''.join(received[0]).count(b'\n'), 10)
+
     def test_duplicate_metric(self):
         t = _get_client()
         for x in range(10):
@@ -44,10 +202,55 @@ class TestPotsDB(TestCase):
         t.wait()
         assert t.queued == 1  # should not queue duplicates
 
+    def test_batched_lines(self):
+        # lines written in batches arrive complete and in order
+        port, server, received = _get_server()
+        t = potsdb.Client('127.0.0.1', port=port, host_tag='tester', check_host=False)
+        lines = [t.log('test.metric12', x, tag1='batch', timestamp=1234567890 + x) for x in range(1000)]
+        t.wait()
+        server.join(5)
+        self.assertEqual(b''.join(received[0]), ''.join(lines).encode('utf-8'))
+
+    def test_duplicate_interleaved_timestamps(self):
+        t = _get_client()
+        for x in range(3):
+            for ts in (1234567890, 1234571490):
+                t.log('test.metric13', 1, cheese='blue', timestamp=ts)
+        t.wait()
+        self.assertEqual(t.queued, 2)
+
+    def test_duplicate_shared_index(self):
+        for dedup in (potsdb.DedupIndex(), potsdb.BloomDedupIndex(capacity=1000)):
+            t1 = _get_client(dedup=dedup)
+            t2 = _get_client(dedup=dedup)
+            for x in range(10):
+                t1.log('test.metric14', 1, cheese='blue', timestamp=1234567890 + x)
+                t2.log('test.metric14', 1, cheese='blue', timestamp=1234567890 + x)
+            t1.wait()
+            t2.wait()
+            self.assertEqual(t1.queued + t2.queued, 10)
+
+    def test_duplicate_index_bounded(self):
+        dedup = potsdb.DedupIndex(max_size=10)
+        t = _get_client(dedup=dedup, host_tag=None)
+        for x in range(100):
+            t.log('test.metric15', 1, cheese='blue', timestamp=1234567890 + x)
+        t.wait()
+        self.assertEqual(len(dedup), 10)
+        self.assertTrue(dedup.seen(('test.metric15', 1234567989, 'cheese=blue')))
+
+    def test_no_duplicate_check(self):
+        t = _get_client(dedup=False)
+        for x in range(10):
+            t.log('test.metric16', 1, cheese='blue')
+        t.wait()
+        self.assertEqual(t.queued, 10)
+
     def test_invalid_metric_name(self):
         # Attempts to send a metric with invalid name (spaces)
         t = _get_client()
         self.assertRaises(AssertionError, lambda: t.log('test.metric2 roflcopter!', 1, cheese='blue'))
+        self.assertRaises(AssertionError, lambda: t.log('test.metric2\n', 1, cheese='blue'))
         self.assertEqual(t.queued, 0)
         t.stop()
 
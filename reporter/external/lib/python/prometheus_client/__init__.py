@@ -25,6 +25,8 @@ write_to_textfile = exposition.write_to_textfile
 push_to_gateway = exposition.push_to_gateway
 pushadd_to_gateway = exposition.pushadd_to_gateway
 delete_from_gateway = exposition.delete_from_gateway
+push_shards_to_gateway = exposition.push_shards_to_gateway
+pushed_shards_of_gateway = exposition.pushed_shards_of_gateway
 instance_ip_grouping_key = exposition.instance_ip_grouping_key
 
 ProcessCollector = process_collector.ProcessCollector
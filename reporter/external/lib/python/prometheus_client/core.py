@@ -491,6 +491,20 @@ else:
     _ValueClass = _MutexValue
 
 
+class _Labels(dict):
+    '''The labels of a child of a metric with labels.
+
+    A child has the same labels for its lifetime, so one _Labels is created
+    with the child and given with all its samples. The exposition caches the
+    labels rendered in the text format in text.
+    '''
+    __slots__ = ['text']
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.text = None
+
+
 class _LabelWrapper(object):
     '''Handles labels for the wrapped metric.'''
     def __init__(self, wrappedClass, name, labelnames, **kwargs):
@@ -501,6 +515,8 @@ class _LabelWrapper(object):
         self._kwargs = kwargs
         self._lock = Lock()
         self._metrics = {}
+        # The labels and the child, for each label values.
+        self._series = {}
 
         for l in labelnames:
             if l.startswith('__'):
@@ -543,6 +559,7 @@ class _LabelWrapper(object):
         with self._lock:
             if labelvalues not in self._metrics:
                 self._metrics[labelvalues] = self._wrappedClass(self._name, self._labelnames, labelvalues, **self._kwargs)
+                self._series[labelvalues] = (_Labels(zip(self._labelnames, labelvalues)), self._metrics[labelvalues])
             return self._metrics[labelvalues]
 
     def remove(self, *labelvalues):
@@ -552,14 +569,25 @@ class _LabelWrapper(object):
         labelvalues = tuple([unicode(l) for l in labelvalues])
         with self._lock:
             del self._metrics[labelvalues]
+            del self._series[labelvalues]
+
+    def clear(self):
+        '''Remove all labelsets from the metric.'''
+        with self._lock:
+            self._metrics = {}
+            self._series = {}
 
     def _samples(self):
         with self._lock:
-            metrics = self._metrics.copy()
-        for labels, metric in metrics.items():
-            series_labels = list(dict(zip(self._labelnames, labels)).items())
+            series = list(self._series.values())
+        for series_labels, metric in series:
             for suffix, sample_labels, value in metric._samples():
-                yield (suffix, dict(series_labels + list(sample_labels.items())), value)
+                if sample_labels:
+                    labels = dict(series_labels)
+                    labels.update(sample_labels)
+                    yield (suffix, labels, value)
+                else:
+                    yield (suffix, series_labels, value)
 
 
 def _MetricWrapper(cls):
@@ -594,8 +622,8 @@ def _MetricWrapper(cls):
 
         def collect():
             metric = Metric(full_name, documentation, cls._type)
-            for suffix, labels, value in collector._samples():
-                metric.add_sample(full_name + suffix, labels, value)
+            metric.samples = [(full_name + suffix, labels, value)
+                              for suffix, labels, value in collector._samples()]
             return [metric]
         collector.collect = collect
 
@@ -3,18 +3,22 @@
 from __future__ import unicode_literals
 
 import base64
+import hashlib
 import os
 import socket
 import sys
 import threading
+import zlib
 from contextlib import closing
 from wsgiref.simple_server import make_server, WSGIRequestHandler
 
 from . import core
+from . import parser
 try:
     from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
     from SocketServer import ThreadingMixIn
     from urllib2 import build_opener, Request, HTTPHandler
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
     from urllib import quote_plus
     from urlparse import parse_qs, urlparse
 except ImportError:
@@ -22,6 +26,7 @@ except ImportError:
     from http.server import BaseHTTPRequestHandler, HTTPServer
     from socketserver import ThreadingMixIn
     from urllib.request import build_opener, Request, HTTPHandler
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
     from urllib.parse import quote_plus, parse_qs, urlparse
 
 
@@ -62,22 +67,36 @@ def start_wsgi_server(port, addr='', registry=core.REGISTRY):
     t.start()
 
 
+def _format_labels(labels):
+    return '{{{0}}}'.format(','.join(
+        ['{0}="{1}"'.format(
+         k, v.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
+         for k, v in sorted(labels.items())]))
+
+
 def generate_latest(registry=core.REGISTRY):
     '''Returns the metrics from the registry in latest text format as a string.'''
     output = []
+    append = output.append
     for metric in registry.collect():
-        output.append('# HELP {0} {1}'.format(
+        append('# HELP {0} {1}'.format(
             metric.name, metric.documentation.replace('\\', r'\\').replace('\n', r'\n')))
-        output.append('\n# TYPE {0} {1}\n'.format(metric.name, metric.type))
+        append('\n# TYPE {0} {1}\n'.format(metric.name, metric.type))
         for name, labels, value in metric.samples:
-            if labels:
-                labelstr = '{{{0}}}'.format(','.join(
-                    ['{0}="{1}"'.format(
-                     k, v.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
-                     for k, v in sorted(labels.items())]))
-            else:
+            if not labels:
                 labelstr = ''
-            output.append('{0}{1} {2}\n'.format(name, labelstr, core._floatToGoString(value)))
+            elif labels.__class__ is core._Labels:
+                # The labels of a child, rendered once for all its samples.
+                labelstr = labels.text
+                if labelstr is None:
+                    labelstr = labels.text = _format_labels(labels)
+            else:
+                labelstr = _format_labels(labels)
+            if value.__class__ is float and core._MINUS_INF < value < core._INF:
+                value = repr(value)
+            else:
+                value = core._floatToGoString(value)
+            append(name + labelstr + ' ' + value + '\n')
     return ''.join(output).encode('utf-8')
 
 
@@ -161,6 +180,72 @@ def default_handler(url, method, timeout, headers, data):
     return handle
 
 
+class KeepAliveHandler(object):
+    '''Handler that keeps the HTTP/HTTPS connection to each host open.
+
+    Used like default_handler by the push_to_gateway functions, the requests
+    of successive pushes to the same pushgateway are sent over one persistent
+    connection. A request failing on a connection that was kept open is
+    sent again over a new connection. Call close() after the last push.'''
+    def __init__(self):
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def _connection(self, scheme, netloc, timeout):
+        conn = self._connections.get((scheme, netloc))
+        if conn is not None:
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return conn, True
+        if scheme == 'https':
+            conn = HTTPSConnection(netloc, timeout=timeout)
+        else:
+            conn = HTTPConnection(netloc, timeout=timeout)
+        conn.connect()
+        # Small requests follow each other on the connection, they are not delayed.
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._connections[(scheme, netloc)] = conn
+        return conn, False
+
+    def _discard(self, scheme, netloc):
+        conn = self._connections.pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def __call__(self, url, method, timeout, headers, data):
+        def handle():
+            parsed = urlparse(url)
+            path = parsed.path
+            if parsed.query:
+                path = path + '?' + parsed.query
+            with self._lock:
+                while True:
+                    conn, reused = self._connection(parsed.scheme, parsed.netloc, timeout)
+                    try:
+                        conn.request(method, path, data, dict(headers))
+                        resp = conn.getresponse()
+                        resp.read()
+                        break
+                    except (HTTPException, socket.error):
+                        # The server may have closed the connection kept open.
+                        self._discard(parsed.scheme, parsed.netloc)
+                        if not reused:
+                            raise
+                if resp.will_close:
+                    self._discard(parsed.scheme, parsed.netloc)
+            if resp.status >= 400:
+                raise IOError("error talking to pushgateway: {0} {1}".format(
+                    resp.status, resp.reason))
+
+        return handle
+
+    def close(self):
+        '''Close the connections kept open.'''
+        with self._lock:
+            for key in list(self._connections):
+                self._discard(*key)
+
+
 def basic_auth_handler(url, method, timeout, headers, data, username=None, password=None):
     '''Handler that implements HTTP/HTTPS connections with Basic Auth.
 
@@ -179,7 +264,8 @@ def basic_auth_handler(url, method, timeout, headers, data, username=None, passw
     return handle
 
 
-def push_to_gateway(gateway, job, registry, grouping_key=None, timeout=None, handler=default_handler):
+def push_to_gateway(gateway, job, registry, grouping_key=None, timeout=None, handler=default_handler,
+        compress=False):
     '''Push metrics to the given pushgateway.
 
     `gateway` the url for your push gateway. Either of the form
@@ -215,13 +301,16 @@ def push_to_gateway(gateway, job, registry, grouping_key=None, timeout=None, han
               failure.
               'content' is the data which should be used to form the HTTP
               Message Body.
+    `compress` if True, the metrics are sent gzip-compressed.
+              Defaults to False
 
     This overwrites all metrics with the same job and grouping_key.
     This uses the PUT HTTP method.'''
-    _use_gateway('PUT', gateway, job, registry, grouping_key, timeout, handler)
+    _use_gateway('PUT', gateway, job, registry, grouping_key, timeout, handler, compress)
 
 
-def pushadd_to_gateway(gateway, job, registry, grouping_key=None, timeout=None, handler=default_handler):
+def pushadd_to_gateway(gateway, job, registry, grouping_key=None, timeout=None, handler=default_handler,
+        compress=False):
     '''PushAdd metrics to the given pushgateway.
 
     `gateway` the url for your push gateway. Either of the form
@@ -239,10 +328,12 @@ def pushadd_to_gateway(gateway, job, registry, grouping_key=None, timeout=None,
               will be carried out by a default handler.
               See the 'prometheus_client.push_to_gateway' documentation
               for implementation requirements.
+    `compress` if True, the metrics are sent gzip-compressed.
+              Defaults to False
 
     This replaces metrics with the same name, job and grouping_key.
     This uses the POST HTTP method.'''
-    _use_gateway('POST', gateway, job, registry, grouping_key, timeout, handler)
+    _use_gateway('POST', gateway, job, registry, grouping_key, timeout, handler, compress)
 
 
 def delete_from_gateway(gateway, job, grouping_key=None, timeout=None, handler=default_handler):
@@ -268,14 +359,124 @@ def delete_from_gateway(gateway, job, grouping_key=None, timeout=None, handler=d
     _use_gateway('DELETE', gateway, job, None, grouping_key, timeout, handler)
 
 
-def _use_gateway(method, gateway, job, registry, grouping_key, timeout, handler):
+def push_shards_to_gateway(gateway, job, registry, shard_label, digests, grouping_key=None,
+        timeout=None, handler=default_handler, compress=False, present=None):
+    '''Push metrics to the given pushgateway, in one group per value of a label.
+
+    The samples with the same value of `shard_label` form a shard, pushed with
+    the label value added to the `grouping_key`; the samples without the label
+    form the shard pushed with the `grouping_key` itself. The other arguments
+    are as for push_to_gateway.
+
+    `digests` is a dict of the label values to the digests of the shards last
+              pushed, updated in place as the shards are pushed. A shard with
+              the same digest as last pushed is not pushed again, the groups of
+              the shards no longer in the registry are deleted. If `digests` is
+              empty, the group of the `grouping_key` itself is replaced as well,
+              to remove metrics pushed to it without sharding.
+    `present` is the set of the label values of the groups on the pushgateway,
+              see pushed_shards_of_gateway. If given, a shard missing on the
+              pushgateway (e.g. restarted since) is pushed even if unchanged.
+
+    Returns the number of shards pushed or deleted.
+    This uses the PUT and DELETE HTTP methods.'''
+    if grouping_key is None:
+        grouping_key = {}
+
+    def shard_key(value):
+        if value == '':
+            return grouping_key
+        key = dict(grouping_key)
+        key[shard_label] = value
+        return key
+
+    shards = _shard_registry(registry, shard_label)
+    if not digests and '' not in shards:
+        digests[''] = None
+
+    count = 0
+    for value in sorted(shards):
+        data = generate_latest(shards[value])
+        digest = hashlib.sha1(data).hexdigest()
+        if digests.get(value) == digest and (present is None or value in present):
+            continue
+        _use_gateway('PUT', gateway, job, None, shard_key(value), timeout, handler, compress, data)
+        digests[value] = digest
+        count += 1
+    for value in sorted(set(digests) - set(shards)):
+        _use_gateway('DELETE', gateway, job, None, shard_key(value), timeout, handler)
+        del digests[value]
+        count += 1
+    return count
+
+
+def pushed_shards_of_gateway(gateway, job, shard_label, grouping_key=None, timeout=None):
+    '''Returns the set of the values of `shard_label` of the groups of the job
+    on the given pushgateway, as pushed by push_shards_to_gateway with the
+    `grouping_key`; '' for the group of the `grouping_key` itself.
+
+    The groups are taken from the push_time_seconds metric of the pushgateway.
+    This uses the GET HTTP method.'''
+    if grouping_key is None:
+        grouping_key = {}
+    url = '{0}/metrics'.format(_gateway_url(gateway))
+    resp = build_opener().open(Request(str(url)), timeout=timeout)
+    try:
+        text = resp.read().decode('utf-8')
+    finally:
+        resp.close()
+
+    present = set()
+    for metric in parser.text_string_to_metric_families(text, names=['push_time_seconds']):
+        for name, labels, value in metric.samples:
+            if labels.get('job') != job:
+                continue
+            if any(labels.get(k, '') != str(v) for k, v in grouping_key.items()):
+                continue
+            present.add(labels.get(shard_label, ''))
+    return present
+
+
+def _shard_registry(registry, label):
+    '''Returns a dict of the values of the label to objects which upon collect()
+    return the samples of the registry with the label value.'''
+    class ShardRegistry(object):
+        def __init__(self):
+            self.metrics = []
+
+        def collect(self):
+            return self.metrics
+
+    shards = {}
+    for metric in registry.collect():
+        parts = {}
+        for sample in metric.samples:
+            value = sample[1].get(label, '')
+            m = parts.get(value)
+            if m is None:
+                m = parts[value] = core.Metric(metric.name, metric.documentation, metric.type)
+                shards.setdefault(value, ShardRegistry()).metrics.append(m)
+            m.samples.append(sample)
+    # The order of the collectors of a registry varies, the digest of a shard must not.
+    for shard in shards.values():
+        shard.metrics.sort(key=lambda m: m.name)
+    return shards
+
+
+def _gateway_url(gateway):
     gateway_url = urlparse(gateway)
     if not gateway_url.scheme or (PYTHON26_OR_OLDER and gateway_url.scheme not in ['http', 'https']):
         gateway = 'http://{0}'.format(gateway)
-    url = '{0}/metrics/job/{1}'.format(gateway, quote_plus(job))
+    return gateway
+
+
+def _use_gateway(method, gateway, job, registry, grouping_key, timeout, handler, compress=False,
+        data=None):
+    url = '{0}/metrics/job/{1}'.format(_gateway_url(gateway), quote_plus(job))
 
-    data = b''
-    if method != 'DELETE':
+    if method == 'DELETE':
+        data = b''
+    elif data is None:
         data = generate_latest(registry)
 
     if grouping_key is None:
@@ -283,8 +484,14 @@ def _use_gateway(method, gateway, job, registry, grouping_key, timeout, handler)
     url = url + ''.join(['/{0}/{1}'.format(quote_plus(str(k)), quote_plus(str(v)))
                              for k, v in sorted(grouping_key.items())])
 
-    headers=[('Content-Type', CONTENT_TYPE_LATEST)]
-    handler(url=url, method=method, timeout=timeout,
+    headers=[(str('Content-Type'), CONTENT_TYPE_LATEST)]
+    if compress and data:
+        # The gzip format, the one of Content-Encoding: gzip.
+        z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = z.compress(data) + z.flush()
+        headers.append((str('Content-Encoding'), str('gzip')))
+    # Native strings, a unicode request can not be joined with a gzip-compressed body.
+    handler(url=str(url), method=str(method), timeout=timeout,
             headers=headers, data=data)()
 
 
@@ -2,25 +2,41 @@
 
 from __future__ import unicode_literals
 
-try:
-    import StringIO
-except ImportError:
-    # Python 3
-    import io as StringIO
+import re
 
 from . import core
 
 
-def text_string_to_metric_families(text):
+def text_string_to_metric_families(text, names=None):
     """Parse Prometheus text format from a unicode string.
 
     See text_fd_to_metric_families.
     """
-    for metric_family in text_fd_to_metric_families(StringIO.StringIO(text)):
+    # Split on newlines only, as reading the lines from a StringIO does.
+    for metric_family in text_fd_to_metric_families(text.split('\n'), names):
       yield metric_family
 
 
+# A sample in the form written by generate_latest: no escapes in the label values,
+# label names and metric names as in the data model. Other samples are parsed by
+# the state machine in _parse_sample_slow.
+_SAMPLE_RE = re.compile(
+    r'([a-zA-Z_:][a-zA-Z0-9_:]*)'
+    r'(?:\{((?:[a-zA-Z_][a-zA-Z0-9_]*="[^"\\]*")(?:,[a-zA-Z_][a-zA-Z0-9_]*="[^"\\]*")*,?)?\}[ \t]*|[ \t]+)'
+    r'([^ \t{][^ \t]*)'
+    r'(?:[ \t].*)?\Z', re.DOTALL)
+_LABEL_RE = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="([^"]*)"')
+# The name of a sample, as taken by _parse_sample_slow from a stripped line.
+_SAMPLE_NAME_RE = re.compile(r'[^{ \t]*')
+
+
 def _unescape_help(text):
+    if '\\' not in text:
+        return text
+    return _unescape_help_slow(text)
+
+
+def _unescape_help_slow(text):
     result = []
     slash = False
 
@@ -46,6 +62,18 @@ def _unescape_help(text):
 
 
 def _parse_sample(text):
+    m = _SAMPLE_RE.match(text)
+    if m is None:
+        return _parse_sample_slow(text)
+    name, labels, value = m.groups()
+    if labels:
+        labels = dict(_LABEL_RE.findall(labels))
+    else:
+        labels = {}
+    return (name, labels, float(value))
+
+
+def _parse_sample_slow(text):
     name = []
     labelname = []
     labelvalue = []
@@ -143,13 +171,17 @@ def _parse_sample(text):
     return (''.join(name), labels, float(''.join(value)))
     
 
-def text_fd_to_metric_families(fd):
+def text_fd_to_metric_families(fd, names=None):
     """Parse Prometheus text format from a file descriptor.
 
     This is a laxer parser than the main Go parser,
     so successful parsing does not imply that the parsed
     text meets the specification.
 
+    If names is given, only the metrics with one of the names,
+    or with samples of one of the names, are yielded. The samples
+    of the other metrics are skipped without being parsed.
+
     Yields core.Metric's.
     """
     name = ''
@@ -157,35 +189,65 @@ def text_fd_to_metric_families(fd):
     typ = 'untyped'
     samples = []
     allowed_names = []
+    skip = False
+    if names is not None:
+        names = set(names)
+    # The same label sets recur in the samples of the metric families.
+    label_cache = {}
+    match_sample = _SAMPLE_RE.match
+    find_labels = _LABEL_RE.findall
 
     def build_metric(name, documentation, typ, samples):
         metric = core.Metric(name, documentation, typ)
         metric.samples = samples
         return metric
 
+    def skipped(name, allowed_names):
+        return names is not None and name not in names and names.isdisjoint(allowed_names)
+
     for line in fd:
-        line = line.strip()
+        if skip:
+            # A sample of a metric not asked for.
+            stripped = line.strip()
+            if stripped and not stripped.startswith('#') and _SAMPLE_NAME_RE.match(stripped).group() in allowed_names:
+                continue
+
+        # Most lines are samples in the form matched by _SAMPLE_RE. Comments and
+        # blank lines never are, they are told apart once the line is stripped.
+        m = match_sample(line)
+        if m is None:
+            line = line.strip()
 
-        if line.startswith('#'):
+        if m is not None:
+            sname, slabels, svalue = m.groups()
+            if slabels:
+                labels = label_cache.get(slabels)
+                if labels is None:
+                    labels = label_cache[slabels] = dict(find_labels(slabels))
+                sample = (sname, labels.copy(), float(svalue))
+            else:
+                sample = (sname, {}, float(svalue))
+        elif line.startswith('#'):
             parts = line.split(None, 3)
             if len(parts) < 2:
                 continue
             if parts[1] == 'HELP':
                 if parts[2] != name:
-                    if name != '':
+                    if name != '' and not skip:
                         yield build_metric(name, documentation, typ, samples)
                     # New metric
                     name = parts[2]
                     typ = 'untyped'
                     samples = []
                     allowed_names = [parts[2]]
+                    skip = skipped(name, allowed_names)
                 if len(parts) == 4:
                   documentation = _unescape_help(parts[3])
                 else:
                   documentation = ''
             elif parts[1] == 'TYPE':
                 if parts[2] != name:
-                    if name != '':
+                    if name != '' and not skip:
                         yield build_metric(name, documentation, typ, samples)
                     # New metric
                     name = parts[2]
@@ -199,26 +261,31 @@ def text_fd_to_metric_families(fd):
                     'histogram': ['_count', '_sum', '_bucket'],
                     }.get(typ, [''])
                 allowed_names = [name + n for n in allowed_names]
+                skip = skipped(name, allowed_names)
             else:
                 # Ignore other comment tokens
                 pass
+            continue
         elif line == '':
             # Ignore blank lines
-            pass
+            continue
         else:
-            sample = _parse_sample(line)
-            if sample[0] not in allowed_names:
-                  if name != '':
-                      yield build_metric(name, documentation, typ, samples)
-                  # New metric, yield immediately as untyped singleton
-                  name = ''
-                  documentation = ''
-                  typ = 'untyped'
-                  samples = []
-                  allowed_names = []
+            sample = _parse_sample_slow(line)
+
+        if sample[0] not in allowed_names:
+              if name != '' and not skip:
+                  yield build_metric(name, documentation, typ, samples)
+              # New metric, yield immediately as untyped singleton
+              name = ''
+              documentation = ''
+              typ = 'untyped'
+              samples = []
+              allowed_names = []
+              skip = False
+              if not skipped(sample[0], [sample[0]]):
                   yield build_metric(sample[0], documentation, typ, [sample])
-            else:
-              samples.append(sample)
+        else:
+          samples.append(sample)
 
-    if name != '':
+    if name != '' and not skip:
         yield build_metric(name, documentation, typ, samples)
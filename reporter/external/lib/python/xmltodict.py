@@ -54,7 +54,9 @@ class _DictSAXHandler(object):
                  strip_whitespace=True,
                  namespace_separator=':',
                  namespaces=None,
-                 force_list=None):
+                 force_list=None,
+                 include_paths=None,
+                 exclude_paths=None):
         self.path = []
         self.stack = []
         self.data = []
@@ -73,6 +75,26 @@ class _DictSAXHandler(object):
         self.namespaces = namespaces
         self.namespace_declarations = OrderedDict()
         self.force_list = force_list
+        self.include_paths = None
+        self.include_prefixes = None
+        if include_paths is not None:
+            self.include_paths = set(map(tuple, include_paths))
+            self.include_prefixes = set(p[:i] for p in self.include_paths
+                                        for i in range(1, len(p)))
+        self.exclude_paths = set(map(tuple, exclude_paths or ()))
+        self.names = []
+        self.skip_depth = 0
+        self.include_depth = 0
+
+    def _should_skip(self, names):
+        if names in self.exclude_paths:
+            return True
+        if self.include_paths is None or self.include_depth:
+            return False
+        if names in self.include_paths:
+            self.include_depth = len(names)
+            return False
+        return names not in self.include_prefixes
 
     def _build_name(self, full_name):
         if not self.namespaces:
@@ -88,7 +110,7 @@ class _DictSAXHandler(object):
             return self.namespace_separator.join((short_namespace, name))
 
     def _attrs_to_dict(self, attrs):
-        if isinstance(attrs, dict):
+        if isinstance(attrs, dict) or not attrs:
             return attrs
         return self.dict_constructor(zip(attrs[0::2], attrs[1::2]))
 
@@ -96,7 +118,16 @@ class _DictSAXHandler(object):
         self.namespace_declarations[prefix or ''] = uri
 
     def startElement(self, full_name, attrs):
+        if self.skip_depth:
+            self.skip_depth += 1
+            return
         name = self._build_name(full_name)
+        if self.include_paths is not None or self.exclude_paths:
+            self.names.append(name)
+            if self._should_skip(tuple(self.names)):
+                self.names.pop()
+                self.skip_depth = 1
+                return
         attrs = self._attrs_to_dict(attrs)
         if attrs and self.namespace_declarations:
             attrs['xmlns'] = self.namespace_declarations
@@ -104,7 +135,7 @@ class _DictSAXHandler(object):
         self.path.append((name, attrs or None))
         if len(self.path) > self.item_depth:
             self.stack.append((self.item, self.data))
-            if self.xml_attribs:
+            if self.xml_attribs and attrs:
                 attr_entries = []
                 for key, value in attrs.items():
                     key = self.attr_prefix+self._build_name(key)
@@ -121,6 +152,13 @@ class _DictSAXHandler(object):
             self.data = []
 
     def endElement(self, full_name):
+        if self.skip_depth:
+            self.skip_depth -= 1
+            return
+        if self.include_depth == len(self.path):
+            self.include_depth = 0
+        if self.names:
+            self.names.pop()
         name = self._build_name(full_name)
         if len(self.path) == self.item_depth:
             item = self.item
@@ -152,6 +190,8 @@ class _DictSAXHandler(object):
         self.path.pop()
 
     def characters(self, data):
+        if self.skip_depth:
+            return
         if not self.data:
             self.data = [data]
         else:
@@ -290,6 +330,20 @@ def parse(xml_input, encoding=None, expat=expat, process_namespaces=False,
         `force_list` can also be a callable that receives `path`, `key` and
         `value`. This is helpful in cases where the logic that decides whether
         a list should be forced is more complex.
+
+    You can use the `include_paths` and `exclude_paths` arguments to parse
+    only part of the document. Both are sequences of element paths, each
+    path being a tuple of element names from the document root. When
+    `include_paths` is given, only the listed elements (with their whole
+    subtrees) and the elements leading to them are kept. Elements listed in
+    `exclude_paths` are dropped with their whole subtrees. Skipped elements
+    are discarded while parsing, so that no dictionary, list or string is
+    created for them:
+
+        >>> xmltodict.parse('<a><b>1</b><c><d>2</d><e>3</e></c></a>',
+        ...                 include_paths=[('a', 'c')],
+        ...                 exclude_paths=[('a', 'c', 'e')])
+        OrderedDict([(u'a', OrderedDict([(u'c', OrderedDict([(u'd', u'2')]))]))])
     """
     handler = _DictSAXHandler(namespace_separator=namespace_separator,
                               **kwargs)
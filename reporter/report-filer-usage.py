@@ -11,7 +11,8 @@ from argparse import ArgumentParser
 from HTMLParser import HTMLParser
 
 # load utility libraries
-from utils.Common import getConfig, getMySQLConnector, pushMetric
+from utils.Common import getConfig, getMySQLConnector
+from utils.Push import getPushDispatcher, addOpenTSDBEndpoints
 from utils.Common import CURLCallback as Callback
 
 def getFilerUsageReport(cfg, fromDate, toDate):
@@ -138,6 +139,10 @@ if __name__ == "__main__":
 
     data = getFilerUsageReport(cfg, args.dateFrom, args.dateTo)
 
+    ## data points are pushed to all URL_PUSH endpoints concurrently, while the next ones are collected
+    pusher = getPushDispatcher(cfg, lv=logging.getLogger().level)
+    addOpenTSDBEndpoints(pusher, cfg)
+
     for d in sorted(data.keys()):
         mlist = []
         for k in data[d].keys():
@@ -148,6 +153,10 @@ if __name__ == "__main__":
             mlist[-1]['tags']   = { 'type': k }
         if not args.dryrun:
             logging.debug('%s', json.dumps(mlist))
-            pushMetric( cfg.get('OpenTSDB','URL_PUSH'), json.dumps(mlist) )
+            pusher.broadcast(mlist)
         else:
             logging.info('%s', json.dumps(mlist))
+
+    # send out the remaining data points
+    if not pusher.wait():
+        logging.error('not all data points are pushed')
@@ -0,0 +1,89 @@
+#!/bin/env python
+
+import os
+import sys
+import logging
+import datetime
+
+from argparse import ArgumentParser, ArgumentTypeError
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(os.path.abspath(__file__))+'/external/lib/python')
+
+from utils.Common import *
+from utils.Metrics import *
+
+if __name__ == "__main__":
+    
+    def checkconfig(path):
+        if not os.path.exists(path):
+            raise ArgumentTypeError('config file not found: %s' % path)
+        return path
+
+    def checkdate(d):
+        try:
+            if len(d) != 8:
+                raise ValueError(d)
+            datetime.datetime.strptime(d, '%Y%m%d')
+        except ValueError:
+            raise ArgumentTypeError('invalid date, expecting YYYYMMDD: %s' % d)
+        return d
+
+    parg = ArgumentParser(description='script for pushing cluster accounting data of the completed jobs', version="0.1")
+
+    parg.add_argument('-l','--loglevel',
+                      action  = 'store',
+                      dest    = 'verbose',
+                      choices = [-1, 0, 1, 2],  ## choices work only with str
+                      default = 0,
+                      type    = int,
+                      help    = 'set one of the following verbosity levels. -1:ERROR, 0|default:WARNING, 1:INFO, 2:DEBUG')
+
+    parg.add_argument('-c', '--config',
+                      action  = 'store',
+                      dest    = 'fconfig',
+                      default = os.path.dirname(os.path.abspath(__file__)) + '/etc/config.ini',
+                      type    = checkconfig,
+                      help    = 'set the configuration parameters, see "config.ini"')
+
+    parg.add_argument('-d', '--date',
+                      action  = 'append',
+                      dest    = 'dates',
+                      default = None,
+                      type    = checkdate,
+                      help    = 'set the date (YYYYMMDD) of the torque log files, can be given multiple times. Default: yesterday, or yesterday and today in the incremental mode')
+
+    parg.add_argument('-i', '--incremental',
+                      action  = 'store_true',
+                      dest    = 'incremental',
+                      default = False,
+                      help    = 'parse only the jobs appended to the torque log files since the previous incremental run, e.g. for running every few minutes, see TORQUE_LOG_STATE in "config.ini"')
+
+    parg.add_argument('-s', '--spread',
+                      action  = 'store_true',
+                      dest    = 'spread',
+                      default = False,
+                      help    = 'spread the used wall-clock and CPU time of the jobs over the time bins in which they were running')
+
+    args = parg.parse_args()
+
+    logger = getMyLogger(os.path.basename(__file__))
+
+    vlv = int(args.verbose)
+    lv  = logging.ERROR
+    if vlv < 0:
+        lv = logging.ERROR
+    elif vlv == 1:
+        lv = logging.INFO
+    elif vlv >= 2:
+        lv = logging.DEBUG
+
+    logger.setLevel(lv)
+
+    m = ClusterAccounting(config=args.fconfig, lv=lv)
+    m.collectMetrics(date=args.dates, incremental=args.incremental, spread=args.spread)
+
+    # the state of the incremental mode is saved once all data points are sent out
+    if not m.pushMetrics():
+        logger.error('not all metrics are pushed')
+        sys.exit(1)
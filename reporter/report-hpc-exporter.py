@@ -0,0 +1,92 @@
+#!/bin/env python
+
+import os
+import sys
+import logging
+
+from argparse import ArgumentParser, ArgumentTypeError
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(os.path.abspath(__file__))+'/external/lib/python')
+
+from utils.Common import *
+from utils.Metrics import *
+from utils.Exporter import *
+
+if __name__ == "__main__":
+    
+    def checkconfig(path):
+        if not os.path.exists(path):
+            raise ArgumentTypeError('config file not found: %s' % path)
+        return path
+
+    parg = ArgumentParser(description='daemon serving cluster (current usage) statistics for Prometheus to scrape', version="0.1")
+
+    parg.add_argument('-l','--loglevel',
+                      action  = 'store',
+                      dest    = 'verbose',
+                      choices = [-1, 0, 1, 2],  ## choices work only with str
+                      default = 0,
+                      type    = int,
+                      help    = 'set one of the following verbosity levels. -1:ERROR, 0|default:WARNING, 1:INFO, 2:DEBUG')
+
+    parg.add_argument('-c', '--config',
+                      action  = 'store',
+                      dest    = 'fconfig',
+                      default = os.path.dirname(os.path.abspath(__file__)) + '/etc/config.ini',
+                      type    = checkconfig,
+                      help    = 'set the configuration parameters, see "config.ini"')
+
+    parg.add_argument('-p', '--port',
+                      action  = 'store',
+                      dest    = 'port',
+                      default = None,
+                      type    = int,
+                      help    = 'set the port on which the metrics are served, overriding EXPORTER_PORT of the config')
+
+    parg.add_argument('-i', '--interval',
+                      action  = 'store',
+                      dest    = 'interval',
+                      default = None,
+                      type    = float,
+                      help    = 'set the seconds between the collections of the metrics, overriding EXPORTER_INTERVAL of the config')
+
+    parg.add_argument('-e', '--energy',
+                      action  = 'store_true',
+                      dest    = 'energy',
+                      default = False,
+                      help    = 'serve the cluster energy consumption as well')
+
+    args = parg.parse_args()
+
+    logger = getMyLogger(os.path.basename(__file__))
+
+    vlv = int(args.verbose)
+    lv  = logging.ERROR
+    if vlv < 0:
+        lv = logging.ERROR
+    elif vlv == 1:
+        lv = logging.INFO
+    elif vlv >= 2:
+        lv = logging.DEBUG
+
+    logger.setLevel(lv)
+
+    c = getConfig(args.fconfig)
+
+    ## the collectors are created once, their metrics are refreshed in place
+    collectors = [ ClusterStatistics(config=args.fconfig, lv=lv) ]
+    if args.energy:
+        collectors.append( ClusterEnergyConsumption(config=args.fconfig, lv=lv) )
+
+    exporter = getMetricsExporter(collectors, c, lv=lv)
+    if args.port is not None:
+        exporter.port = args.port
+    if args.interval is not None:
+        exporter.interval = args.interval
+
+    exporter.start()
+    try:
+        exporter.wait()
+    except KeyboardInterrupt:
+        logger.info('exporter stopped')
@@ -0,0 +1 @@
+.exec_wrapper.sh
\ No newline at end of file
@@ -59,6 +59,12 @@ if __name__ == "__main__":
 
     c = getConfig(args.fconfig)
 
+    # the matlab license usage is probed while the cluster statistics are collected
+    ml = MatlabLicenseAccounting(config=args.fconfig, lv=lv)
+    probes = ProbeRunner(deadline=c.getfloat('TorqueTracker','PROBE_DEADLINE'), lv=lv)
+    probes.add('licenses', ml.BIN_CLUSTER_MATLAB, parse_matlab_license_usage, default=[])
+    probes.start()
+
     m = ClusterStatistics(config=args.fconfig, lv=lv)
     m.collectMetrics()
 
@@ -79,9 +85,12 @@ if __name__ == "__main__":
             msg = '\n'.join(map(lambda x:x[1]['host'], nlist))
             sendEmailNotification('admin@dccn-l034.dccn.nl', c.get('TorqueTracker','NOTIFICATION_EMAILS').split(','), subject, msg)
 
-    # push metrics 
-    m.pushMetrics()
+    # push metrics, the statistics and the license usage are pushed concurrently within one deadline
+    pusher = getPushDispatcher(c, lv=lv)
+    m.pushMetrics(dispatcher=pusher)
 
-    m = MatlabLicenseAccounting(config=args.fconfig, lv=lv)
-    m.collectMetrics()
-    m.pushMetrics()
+    ml.collectMetrics(licenses=probes.wait()['licenses'])
+    ml.pushMetrics(dispatcher=pusher)
+
+    if not pusher.wait():
+        logger.error('not all metrics are pushed')
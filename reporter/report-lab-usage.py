@@ -13,8 +13,10 @@ from argparse import ArgumentParser
 from HTMLParser import HTMLParser
 
 # load utility libraries
-from utils.Common import getConfig, getMySQLConnector, pushMetric
+from utils.Common import getConfig, getMySQLConnector
+from utils.Push import getPushDispatcher, addOpenTSDBEndpoints
 from utils.Common import CURLCallback as Callback
+from utils.Metrics import MetricAggregator
 
 # create a subclass and override the handler methods
 class LabUsageHTMLParser(HTMLParser):
@@ -331,6 +333,10 @@ if __name__ == "__main__":
 
     pgmap = getProjectGroupMap(cfg)
 
+    ## data points are pushed to all URL_PUSH endpoints concurrently, while the next ones are collected
+    pusher = getPushDispatcher(cfg, lv=logging.getLogger().level)
+    addOpenTSDBEndpoints(pusher, cfg)
+
     tbeg = datetime.strptime(args.dateFrom, '%Y-%m-%d')
     tend = datetime.strptime(args.dateTo  , '%Y-%m-%d')
     dt = timedelta(days=1)
@@ -345,8 +351,7 @@ if __name__ == "__main__":
         # filter out the items without 'Source' field in the retrieved lab usage report 
         items = filter( lambda x:eventFilter(x), getLabUsageReport(beg=t, end=t) )
 
-        values = []
-        labels = []
+        usage = MetricAggregator([args.tsname_used])
  
         for d in items:
             duration = float(d['Duration (hours)'])
@@ -357,29 +362,24 @@ if __name__ == "__main__":
                           status=d['Status'],
                           lab=labelize(d['Calendar']),
                           bill=labelize(d['Billing']))
-                try: 
-                    id = labels.index(l)
-                    values[id] += duration
-                except ValueError:
-                    labels.append(l)
-                    values.append(duration)
+                usage.add(args.tsname_used, l.__dict__, duration)
             except:
                 logging.warning('tag(s) not found, item skipped: %s', repr(d))
 
-        for id in xrange(len(labels)):
+        for x in usage[args.tsname_used]:
             m = {}
             m['metric'] = args.tsname_used
-            m['value'] = values[id]
+            m['value'] = x.value
             m['timestamp'] = long(ts.strftime('%s'))
-            m['tags'] = labels[id].__dict__
+            m['tags'] = x.tags
 
             if not args.dryrun:
                 logging.debug('%s: %s', t, json.dumps(m))
-                pushMetric( cfg.get('OpenTSDB','URL_PUSH'), json.dumps(m) )
+                pusher.broadcast(m)
             else:
                 logging.info('%s: %s', t, json.dumps(m))
 
-        logging.debug('%d items --> %d data points', len(items), len(labels))
+        logging.debug('%d items --> %d data points', len(items), len(usage))
 
         # resolve gaps of the day
         gaps = resolveLabUsageGaps(bookings=items, date=t, lab='', tbegDay='08:30:00', tendDay='18:00:00')
@@ -389,6 +389,10 @@ if __name__ == "__main__":
                 g['metric'] = args.tsname_free
                 if not args.dryrun:
                     logging.debug('%s: %s', d, json.dumps(g))
-                    pushMetric( cfg.get('OpenTSDB','URL_PUSH'), json.dumps(g) )
+                    pusher.broadcast(g)
                 else:
                     logging.info('%s: %s', d, json.dumps(g))
+
+    # send out the remaining data points
+    if not pusher.wait():
+        logging.error('not all data points are pushed')
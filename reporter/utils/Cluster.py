@@ -1,47 +1,358 @@
 #!/usr/bin/env python
 import glob
 import os
+import itertools
+import multiprocessing
+import hashlib
+import marshal
+import zlib
+import gzip
+import bz2
 import pprint
 import logging 
 import re 
 import math 
+import time
+import threading
 from Common import getMyLogger
 from Shell import *
+from array import array
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+## value marking an unset numeric attribute in the typed array of a Job
+_NAN = float('nan')
+
+def _typed_attribute(i, kind):
+    '''property giving attribute access to the i-th value in the typed array of a Job'''
+    def fget(self):
+        v = self._values[i]
+        if v != v:
+            return None
+        return kind(v)
+
+    def fset(self, v):
+        if v is None:
+            v = _NAN
+        self._values[i] = v
+
+    return property(fget, fset)
+
+class Job(object):
+    '''data object containing job information
+
+       The numeric attributes (requested and consumed resources, timestamps) are
+       kept in a typed array rather than as separate objects, and unset numeric
+       attributes read as None.  Other attributes are stored in slots, so that
+       a month of completed jobs can be held in memory.
+    '''
+
+    __slots__ = ( '_values',
+                  ## attributes of completed jobs, see get_complete_jobs
+                  'jid', 'jname', 'jstat', 'jec', 'cstat', 'uid', 'gid', 'queue', 'htypes', 'jpath', 'node',
+                  ## attributes of jobs in qstat, see get_qstat_jobs
+                  'sid', 'nds', 'tsk', 'rtime', 'ctime',
+                  ## attributes of matlab license usage, see get_matlab_license_usage
+                  'package', 'host' )
+
+    _numeric = ( ('rmem'    , float),
+                 ('rwtime'  , int  ),
+                 ('cmem'    , float),
+                 ('cvmem'   , float),
+                 ('cwtime'  , int  ),
+                 ('cctime'  , int  ),
+                 ('t_submit', int  ),
+                 ('t_queue' , int  ),
+                 ('t_start' , int  ),
+                 ('t_finish', int  ) )
+
+    _unset = array('d', [ _NAN ] * len(_numeric))
 
-class Job:
-    '''data object containing job information'''
     def __init__(self, **kwargs):
+        self._values = Job._unset[:]
         self.jid = None
-        self.__dict__.update(kwargs)
+        for k, v in kwargs.iteritems():
+            setattr(self, k, v)
+
+    def _asdict(self):
+        '''get the attributes being set as a dictionary'''
+        d = {}
+        for k in Job.__slots__[1:]:
+            try:
+                d[k] = getattr(self, k)
+            except AttributeError:
+                pass
+        for k, kind in Job._numeric:
+            d[k] = getattr(self, k)
+        return d
+
+    def __getstate__(self):
+        return self._asdict()
+
+    def __setstate__(self, state):
+        self._values = Job._unset[:]
+        for k, v in state.iteritems():
+            setattr(self, k, v)
 
     def __str__(self):
-        return pprint.pformat(self.__dict__)
+        return pprint.pformat(self._asdict())
 
     def __repr__(self):
-        return repr(self.__dict__)
+        return repr(self._asdict())
 
     def __eq__(self, other):
         if not isinstance(other, Job):
             raise NotImplementedError
         return self.jid == other.jid
 
-class Node:
+for i, (k, kind) in enumerate(Job._numeric):
+    setattr(Job, k, _typed_attribute(i, kind))
+
+class Node(object):
     '''data object containing node information'''
+
+    __slots__ = ( 'host', 'stat', 'ncores', 'ncores_idle', 'ncores_inter', 'ncores_matlab', 'ncores_vgl',
+                  'ncores_batch', 'cpu_type', 'cpu_speed', 'mem', 'memleft', 'memleft_c', 'ngpus', 'net',
+                  'interactive', 'matlab', 'vgl', 'batch', 'props', 'jobs',
+                  ## attributes of the mentat nodes, see get_mentat_node_properties
+                  'nxvnc', 'load_1m', 'load_5m', 'load_10m', 'total_ps', 'top_ps' )
+
     def __init__(self, **kwargs):
         self.host = None 
-        self.__dict__.update(kwargs)
+        for k, v in kwargs.iteritems():
+            setattr(self, k, v)
+
+    def _asdict(self):
+        '''get the attributes being set as a dictionary'''
+        d = {}
+        for k in Node.__slots__:
+            try:
+                d[k] = getattr(self, k)
+            except AttributeError:
+                pass
+        return d
+
+    def __getstate__(self):
+        return self._asdict()
+
+    def __setstate__(self, state):
+        for k, v in state.iteritems():
+            setattr(self, k, v)
 
     def __str__(self):
-        return pprint.pformat(self.__dict__)
+        return pprint.pformat(self._asdict())
 
     def __repr__(self):
-        return repr(self.__dict__)
+        return repr(self._asdict())
 
     def __eq__(self, other):
         if not isinstance(other, Node):
             raise NotImplementedError
         return self.host == other.host
 
+class JobIndex:
+    '''ordered collection of Job objects indexed by the job id'''
+    def __init__(self, jobs=[]):
+        self._jobs = []
+        self._jids = {}
+        for j in jobs:
+            self.add(j)
+
+    def add(self, job):
+        '''add the job to the collection, if a job with the same job id is already presented,
+           the presented job is returned together with False as the second value'''
+        try:
+            return self._jobs[ self._jids[job.jid] ], False
+        except KeyError:
+            self._jids[job.jid] = len(self._jobs)
+            self._jobs.append( job )
+            return job, True
+
+    def get(self, jid, default=None):
+        '''get the job with the given job id'''
+        try:
+            return self._jobs[ self._jids[jid] ]
+        except KeyError:
+            return default
+
+    def jobs(self):
+        '''get the jobs as a list in the order they are added'''
+        return list(self._jobs)
+
+    def __contains__(self, jid):
+        return jid in self._jids
+
+    def __iter__(self):
+        return iter(self._jobs)
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __getitem__(self, i):
+        return self._jobs[i]
+
+class ClusterSnapshot:
+    '''the nodes and jobs of the cluster at one time, indexed for the collection of statistics
+
+       The snapshot is built once per collection from the nodes of get_cluster_node_properties
+       and the jobs of get_qstat_jobs.  The nodes are indexed by host, the jobs by job id and by
+       state, and the queues by their category: a queue in batch_queues is in the 'batch'
+       category, any other queue is its own category if it is one of categories, or in 'other'.
+
+       A node accepts jobs of a category if its attribute of the same name ('matlab', 'vgl' or
+       'batch') is set; of the 'interact' category if it is interactive, of 'other' always.
+    '''
+    def __init__(self, nodes, jobs, categories, batch_queues):
+        self.nodes        = nodes
+        self.categories   = list(categories)
+        self.batch_queues = set(batch_queues)
+
+        ## host -> node
+        self._hosts = {}
+        for n in nodes:
+            self._hosts[n.host] = n
+
+        ## job id -> job, job state -> jobs
+        self.jobs    = JobIndex()
+        self._states = {}
+        for jstat, jidx in jobs.iteritems():
+            self._states[jstat] = jidx.jobs()
+            for j in jidx:
+                self.jobs.add(j)
+
+        ## queue -> category, filled as queues are looked up
+        self._qcats = {}
+
+        ## category -> nodes accepting jobs of the category
+        self._accepting = {}
+        accepts = { 'interact': lambda n: n.interactive,
+                    'other'   : lambda n: True }
+        for c in self.categories:
+            f = accepts.get(c, lambda n, c=c: getattr(n, c, False))
+            self._accepting[c] = [ n for n in nodes if f(n) ]
+
+    def node(self, host):
+        '''get the node with the given host name, None if the host is not a node of the cluster'''
+        return self._hosts.get(host)
+
+    def job(self, jid):
+        '''get the job with the given job id'''
+        return self.jobs.get(jid)
+
+    def jobs_in(self, states):
+        '''get the jobs in any of the given states, e.g. ['Q','S']'''
+        jobs = []
+        for s in states:
+            jobs.extend(self._states.get(s, []))
+        return jobs
+
+    def category(self, queue):
+        '''get the category of the queue'''
+        try:
+            return self._qcats[queue]
+        except KeyError:
+            cat = queue
+            if queue in self.batch_queues:
+                cat = 'batch'
+            elif queue not in self.categories:
+                cat = 'other'
+            self._qcats[queue] = cat
+            return cat
+
+    def nodes_accepting(self, category):
+        '''get the nodes accepting jobs of the category'''
+        return self._accepting.get(category, [])
+
+    def allocated_cores(self, host, jid):
+        '''get the ids of the cores allocated to the job on the node, None if the host is not a
+           node of the cluster or the job has no cores allocated on it'''
+        n = self._hosts.get(host)
+        if n is None:
+            return None
+        return n.jobs.get(jid)
+
+class ProbeRunner:
+    '''runs probe commands of the cluster (e.g. qstat, pbsnodes) in parallel
+
+       A probe is a shell command and a parser of its output.  The parser is given an iterator
+       over the output lines, which it consumes while the command runs (see Shell.lines).
+       A command is killed after its timeout, and the probes not finished deadline seconds after
+       the start are given up.  The result of a probe is the value returned by its parser, or the
+       default if the command fails or is given up, or its output cannot be parsed.
+    '''
+    def __init__(self, deadline=None, lv=logging.ERROR):
+
+        self.logger = getMyLogger(self.__class__.__name__)
+        self.logger.setLevel(lv)
+
+        self.deadline = deadline
+        self.shell    = Shell(debug=False)
+
+        self._probes  = []
+        self._threads = []
+        self._results = {}
+        self._tstart  = None
+
+    def add(self, name, cmd, parser, default=None, timeout=300, allowed_exit=[0,255]):
+        '''add a probe, the result of which is keyed by name'''
+        self._probes.append( (name, cmd, parser, default, timeout, allowed_exit) )
+
+    def _run(self, name, cmd, parser, timeout, allowed_exit):
+        '''the thread of a probe'''
+        try:
+            t = time.time()
+            ## the output is parsed while the command is writing it
+            c = self.shell.lines(cmd, allowed_exit=allowed_exit, timeout=timeout)
+            try:
+                result = parser(c)
+            finally:
+                rc = c.wait()
+            if rc != 0:
+                self.logger.error('command %s return non-exit code: %d' % (cmd, rc))
+                return
+            self.logger.debug('command %s finished in %.1f seconds' % (cmd, time.time() - t))
+            self._results[name] = result
+        except Exception, e:
+            self.logger.error('probe %s failed: %s' % (name, e))
+
+    def start(self):
+        '''start the commands of the probes'''
+        self._tstart = time.time()
+        for name, cmd, parser, default, timeout, allowed_exit in self._probes:
+            if self.deadline is not None:
+                timeout = min(timeout, self.deadline)
+            t = threading.Thread(target=self._run, args=(name, cmd, parser, timeout, allowed_exit), name='probe %s' % name)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def wait(self):
+        '''wait until the probes are finished, or the deadline passes; returns a dictionary with
+           the result of each probe'''
+        results = {}
+        for (name, cmd, parser, default, timeout, allowed_exit), t in zip(self._probes, self._threads):
+            remaining = None
+            if self.deadline is not None:
+                remaining = max(0, self._tstart + self.deadline - time.time())
+            t.join(remaining)
+            if t.is_alive():
+                self.logger.error('probe %s not finished before the deadline' % name)
+                results[name] = default
+            else:
+                results[name] = self._results.get(name, default)
+        return results
+
+    def run(self):
+        '''run the probes, returns a dictionary with the result of each probe'''
+        self.start()
+        return self.wait()
+
 def interpret_job_ec(ec):
     '''interpret job exit code in the torque logfile into major catagories'''
     
@@ -58,8 +369,290 @@ def interpret_job_ec(ec):
 
     return cstat
 
-def get_complete_jobs(logdir, date, debug=False):
-    '''gets all completed jobs on the given date expressed in format of %Y%m%d (i.e. 20140130)'''
+## elements of the Jobinfo blocks used by get_complete_jobs, the rest of the torque
+## log (e.g. the large Variable_List with the job environment) is skipped by the parser
+TORQUE_JOBINFO_FIELDS = [ 'Job_Id', 'Job_Name', 'Job_Owner', 'job_state', 'queue', 'egroup',
+                          'Resource_List', 'resources_used', 'exit_status', 'exec_host',
+                          'Hold_Types', 'Join_Path', 'ctime', 'qtime', 'start_time', 'comp_time' ]
+
+## decompressors of the rotated torque log files by the file extension
+TORQUE_LOG_COMPRESSIONS = { '.gz' : lambda fpath: gzip.open(fpath, 'rb'),
+                            '.bz2': lambda fpath: bz2.BZ2File(fpath, 'r') }
+if lzma:
+    TORQUE_LOG_COMPRESSIONS['.xz'] = lambda fpath: lzma.LZMAFile(fpath, 'rb')
+
+def is_compressed_log(fpath):
+    '''check if the torque log file is compressed by gzip, bzip2 or xz'''
+    return os.path.splitext(fpath)[1] in ['.gz', '.bz2', '.xz']
+
+def open_torque_log(fpath):
+    '''open the torque log file for reading, the compressed file is decompressed while being read'''
+    ext = os.path.splitext(fpath)[1]
+    if ext in TORQUE_LOG_COMPRESSIONS:
+        return TORQUE_LOG_COMPRESSIONS[ext](fpath)
+    if is_compressed_log(fpath):
+        raise IOError('cannot decompress %s, no python module for %s' % (fpath, ext))
+    return open(fpath, 'r')
+
+class TorqueLogReader:
+    '''file-like object streaming a torque log (XML) file with the known defects fixed on the fly
+
+       The torque log is a sequence of Jobinfo blocks without an overarching
+       element.  The reader wraps the blocks into a <data> element and applies
+       the fixes line by line, so that the XML parser consumes the log in chunks
+       rather than the whole file being loaded in memory.  The compressed log
+       files are decompressed on the fly, see open_torque_log.
+
+       If complete is True, the lines of a Jobinfo block are held back until the
+       block is closed, so that a block still being written by the torque server
+       is left out.  The offset attribute is the position in the file up to which
+       the content has been passed on to the parser.
+    '''
+
+    def __init__(self, fpath, beg=0, end=None, complete=False):
+        self.fpath  = fpath
+        self.offset = beg
+        self._f     = open_torque_log(fpath)
+        self._buf   = '<data>\n'
+        self._eof   = False
+        self._pos   = beg
+        self._end   = end
+        self._held  = None
+        if complete:
+            self._held = []
+
+        if beg:
+            self._f.seek(beg)
+
+    def read(self, size=-1):
+        chunks = [ self._buf ]
+        nbytes = len(self._buf)
+        while not self._eof and ( size < 0 or nbytes < size ):
+            l = ''
+            if self._end is None or self._pos < self._end:
+                l = self._f.readline()
+                self._pos += len(l)
+            if l:
+                # fix incorrect closing tag
+                l = l.replace('JobId', 'Job_Id')
+                if self._held is not None:
+                    self._held.append(l)
+                    if l.strip() != '</Jobinfo>':
+                        continue
+                    l = ''.join(self._held)
+                    self._held = []
+                self.offset = self._pos
+            else:
+                # fix the fact that there is no overarching beginning and end tag.
+                l = '\n</data>'
+                self._eof = True
+            chunks.append(l)
+            nbytes += len(l)
+
+        data = ''.join(chunks)
+        if size < 0 or nbytes <= size:
+            self._buf = ''
+            return data
+
+        self._buf = data[size:]
+        return data[:size]
+
+    def close(self):
+        self._f.close()
+
+def split_torque_log(fpath, nparts, min_size=4*1024**2):
+    '''split the torque log (XML) file into at most nparts byte ranges of at least min_size bytes,
+       the ranges are separated at the beginning of Jobinfo blocks and returned as (beg, end) tuples
+
+       A compressed file is not split, as its content cannot be accessed at random positions.
+    '''
+
+    if is_compressed_log(fpath):
+        return [ (0, None) ]
+
+    size   = os.path.getsize(fpath)
+    nparts = max(1, min(nparts, size / min_size))
+
+    bounds = [0]
+    f = open(fpath, 'r')
+    try:
+        for i in xrange(1, nparts):
+            pos = max(size * i / nparts, bounds[-1])
+            f.seek(pos)
+            l = f.readline()     # skip the (partial) line at the seek position
+            pos += len(l)
+            while l:
+                l = f.readline()
+                if l.lstrip().startswith('<Jobinfo>'):
+                    bounds.append(pos)
+                    break
+                pos += len(l)
+    finally:
+        f.close()
+    bounds.append(size)
+
+    return [ (b, e) for b, e in zip(bounds[:-1], bounds[1:]) if e > b ]
+
+def parse_torque_log(fpath, callback, beg=0, end=None, complete=False):
+    '''parse the torque log (XML) file in streaming mode, the callback is called with
+       the dictionary of each Jobinfo block as soon as the block is closed
+
+       It returns the offset in the file up to which the log has been parsed, see TorqueLogReader.
+    '''
+    import xmltodict
+
+    def __handle_item__(path, item):
+        if path[-1][0] == 'Jobinfo':
+            callback(item)
+        return True
+
+    f = TorqueLogReader(fpath, beg, end, complete)
+    try:
+        xmltodict.parse(f, item_depth=2, item_callback=__handle_item__, dict_constructor=dict,
+                        include_paths=[ ('data', 'Jobinfo', k) for k in TORQUE_JOBINFO_FIELDS ])
+    finally:
+        f.close()
+
+    return f.offset
+
+class TorqueLogOffsets(dict):
+    '''offsets up to which the torque log files have been parsed, keyed by the file path
+
+       The value is a tuple of (inode, size, offset) of the file at the time it was parsed.
+       A file is parsed from the beginning again if it has been rotated, i.e. its inode has
+       changed or its size has changed to below the offset.  The offset of a compressed file
+       refers to the decompressed content.  Being a dictionary of basic types,
+       it can be stored in and loaded from a JSON document.
+    '''
+
+    def begin(self, fpath):
+        '''get the offset from which the file should be parsed'''
+        try:
+            inode, size, offset = self[fpath]
+            st = os.stat(fpath)
+        except (KeyError, ValueError, TypeError, OSError):
+            return 0
+
+        if st.st_ino != inode or ( st.st_size != size and st.st_size < offset ):
+            return 0
+
+        return offset
+
+    def mark(self, fpath, offset):
+        '''record the offset up to which the file has been parsed'''
+        st = os.stat(fpath)
+        self[fpath] = (st.st_ino, st.st_size, offset)
+
+    def retain(self, fpaths):
+        '''forget the offsets of the files other than the given ones, e.g. of the past dates'''
+        fpaths = set(fpaths)
+        for fpath in self.keys():
+            if fpath not in fpaths:
+                del self[fpath]
+
+def read_torque_log(fpath, beg=0, end=None):
+    '''get the list of Jobinfo dictionaries in the torque log (XML) file or in the byte range of it'''
+    cjobs = []
+    parse_torque_log(fpath, cjobs.append, beg, end)
+    return cjobs
+
+def _read_torque_log_part(args):
+    '''read_torque_log taking the arguments as one tuple, for the process pool'''
+    return read_torque_log(*args)
+
+class TorqueLogCache:
+    '''on-disk cache of the Jobinfo dictionaries parsed from the torque log files
+
+       A cache entry is keyed by the path, the modification time and the size of the log
+       file, so that a file changed afterwards is parsed again.  The entries are stored as
+       zlib-compressed marshal data in the cache directory.  When the total size of the
+       entries exceeds max_size bytes, the least recently used entries are removed.
+    '''
+
+    version = 1
+
+    def __init__(self, cdir, max_size=1024**3):
+        self.cdir     = cdir
+        self.max_size = max_size
+        self.logger   = getMyLogger(self.__class__.__name__)
+
+        if not os.path.exists(cdir):
+            os.makedirs(cdir)
+
+    def _path(self, fpath):
+        st  = os.stat(fpath)
+        key = repr((self.version, os.path.abspath(fpath), st.st_mtime, st.st_size, TORQUE_JOBINFO_FIELDS))
+        return os.path.join(self.cdir, hashlib.sha1(key).hexdigest() + '.jobs')
+
+    def get(self, fpath):
+        '''get the list of Jobinfo dictionaries of the log file, or None if it is not in the cache'''
+        cpath = self._path(fpath)
+        try:
+            f = open(cpath, 'rb')
+            try:
+                cjobs = marshal.loads(zlib.decompress(f.read()))
+            finally:
+                f.close()
+            os.utime(cpath, None)
+        except IOError, e:
+            return None
+        except (ValueError, EOFError, TypeError, zlib.error), e:
+            self.logger.warning('ignore corrupted cache of logfile %s: %s' % (fpath, e))
+            return None
+
+        self.logger.debug('cache hit for logfile %s: %s' % (fpath, cpath))
+        return cjobs
+
+    def put(self, fpath, cjobs):
+        '''store the list of Jobinfo dictionaries of the log file in the cache'''
+        cpath = self._path(fpath)
+        tpath = '%s.%d.tmp' % (cpath, os.getpid())
+        f = open(tpath, 'wb')
+        try:
+            f.write(zlib.compress(marshal.dumps(cjobs, 2), 1))
+        finally:
+            f.close()
+        os.rename(tpath, cpath)
+
+        self.evict()
+
+    def evict(self):
+        '''remove the least recently used entries until the total size is within max_size'''
+        entries = []
+        for n in os.listdir(self.cdir):
+            if n.endswith('.jobs'):
+                try:
+                    st = os.stat(os.path.join(self.cdir, n))
+                    entries.append((st.st_mtime, st.st_size, n))
+                except OSError, e:
+                    pass
+
+        total = sum(map(lambda x:x[1], entries))
+        for t, size, n in sorted(entries):
+            if total <= self.max_size:
+                break
+            self.logger.debug('evict cache entry: %s' % n)
+            try:
+                os.remove(os.path.join(self.cdir, n))
+            except OSError, e:
+                pass
+            total -= size
+
+def get_complete_jobs(logdir, date, debug=False, nprocs=1, offsets=None, cache=None):
+    '''gets all completed jobs on the given date expressed in format of %Y%m%d (i.e. 20140130)
+
+       The date can also be a list of dates.  If nprocs is larger than 1, the log files are
+       split into parts that are parsed in a pool of nprocs processes, and the jobs are merged
+       in the order of the files and parts, as in the serial processing.
+
+       If offsets (a TorqueLogOffsets) is given, only the Jobinfo blocks appended to the log
+       files since the offsets are parsed, and the offsets are moved to the end of the last
+       complete block in the files; the offsets of the files of other dates are forgotten.
+       It always processes the files in serial.
+
+       If cache (a TorqueLogCache) is given, the Jobinfo dictionaries of the log files are
+       taken from the cache, and those of the log files not in the cache are stored into it.
+    '''
 
     def __convert_memory__(mymem):
         '''check if memory type is specified else default to mb'''
@@ -82,187 +675,229 @@ def get_complete_jobs(logdir, date, debug=False):
 
         return gb_mem
 
-    def __readfix_xml__(myfile):
-        '''read and parse the torque log (XML) file'''
-        import xmltodict
- 
-        # open xml file and do some fixing
-        temp = open(myfile, 'r').read()
-        # fix incorrect closing tag
-        #temp = temp.replace('JobId', 'Job_Id')
-        temp = re.sub(r'<Variable_List>.*</Variable_List>', '', temp.replace('JobId', 'Job_Id'))
-        # fix the fact that there is no overarching beginning and end tag.
-        temp = '<data>\n' + temp + '\n</data>'
+    def __compact_str__(s, shared=False):
+        '''store ASCII-only text as byte string, and keep one copy of the strings shared by many jobs'''
+        try:
+            s = s.encode('ascii')
+        except (UnicodeError, AttributeError):
+            pass
+        if shared:
+            s = strings.setdefault(s, s)
+        return s
+
+    def __update_job__(j):
+        '''convert the Jobinfo dictionary into a Job object and merge it into the job list'''
+
+        o = Job( jid      = __compact_str__(j['Job_Id']),                  # torque job id
+                 jname    = None,                         # torque job name
+                 jstat    = None,                         # torque job status
+                 jec      = None,                         # job exit code
+                 cstat    = 'unknown',                    # category status interpreted from jec 
+                 uid      = None,                         # job owner
+                 gid      = None,                         # job owner's group id
+                 queue    = None,                         # job queue
+                 rmem     = 0,                            # requested memory in byte 
+                 rwtime   = 0,                            # requested wall-clock time in second
+                 htypes   = None,                         # the Job's Hold_Types 
+                 jpath    = None,                         # the Job's Join_Path 
+                 cmem     = None,                         # consumed physical memory in byte
+                 cvmem    = None,                         # consumed virtual memory in byte
+                 cwtime   = None,                         # consumed wall-clock time in second
+                 cctime   = None,                         # consumed CPU time in second
+                 node     = None,                         # compute node host
+                 t_submit = None,                         # timestamp for job being submitted to Torque
+                 t_queue  = None,                         # timestamp for job being scheduled in the queue 
+                 t_start  = None,                         # timestamp for job being started on execution node 
+                 t_finish = None                          # timestamp for job being completed 
+               )
+       
+        ## handles the retried jobs (seperate entry in log file with same job id)
+        o, is_newjob = jlist.add( o )
+        if not is_newjob:
+            logger.warning('job already presented in list: %s' % o.jid)
  
-        # read xml string
-        xmldoc = xmltodict.parse(temp)
- 
-        # return list containing subdict for each job
-        cjobs = xmldoc['data']['Jobinfo']
+        ## attributes may not be available 
+        ## - resource requirement
+        try:
+            o.jname  = __compact_str__(j['Job_Name'])
+        except KeyError,e:
+            logger.warning('cannot find "Job_Name" for job %s' % o.jid)
+
+        ## - resource requirement
+        try:
+            o.rmem   = __convert_memory__( j['Resource_List']['mem'] )
+            o.rwtime = int( j['Resource_List']['walltime'] )
+        except KeyError,e:
+            logger.warning('cannot find "Resource_List" for job %s' % o.jid)
+        except TypeError,e:
+            logger.warning('empty "Resource_List" for job %s' % o.jid)
+        
+        ## - resource consumption
+        try:
+            o.cmem   = __convert_memory__( j['resources_used']['mem']  )
+            o.cvmem  = __convert_memory__( j['resources_used']['vmem'] )
+            o.cwtime = int( j['resources_used']['walltime'] )
+            o.cctime = int( j['resources_used']['cput'] )
+
+            if o.cctime > o.cwtime:
+                logger.warning('Job %s: CPU time consumption (%d) > wallclock time consumption (%d)' % (o.jid, o.cctime, o.cwtime))
+
+        except KeyError,e:
+            logger.warning('cannot find "resources_used" for job %s' % o.jid)
+
+        ## - job exit status 
+        try:
+            o.jec   = int( j['exit_status'] )
+            o.cstat = interpret_job_ec( o.jec ) 
+        except KeyError,e:
+            logger.warning('cannot find "exit_status" for job %s' % o.jid)
+
+        ## - job execution host 
+        try:
+            o.node = __compact_str__(j['exec_host'], shared=True)
+        except KeyError,e:
+            logger.warning('cannot find "exec_host" for job %s' % o.jid)
+
+        ## - job state 
+        try:
+            o.jstat = __compact_str__(j['job_state'], shared=True)
+        except KeyError,e:
+            logger.warning('cannot find "job_state" for job %s' % o.jid)
+
+        ## - job owner
+        try:
+           o.uid = __compact_str__(j['Job_Owner'].split('@')[0], shared=True)
+        except KeyError,e:
+            logger.warning('cannot find "Job_Owner" for job %s' % o.jid)
+
+        ## - job owner's group
+        try:
+           o.gid = __compact_str__(j['egroup'], shared=True)
+        except KeyError,e:
+            logger.warning('cannot find "egroup" for job %s' % o.jid)
+
+        ## - job queue 
+        try:
+           o.queue = __compact_str__(j['queue'], shared=True)
+        except KeyError,e:
+            logger.warning('cannot find "queue" for job %s' % o.jid)
+
+        ## - job Hold_Types 
+        try:
+           o.htypes = __compact_str__(j['Hold_Types'], shared=True)
+        except KeyError,e:
+            logger.warning('cannot find "Hold_Types" for job %s' % o.jid)
+
+        ## - job Join_Path
+        try:
+           o.jpath = __compact_str__(j['Join_Path'], shared=True)
+        except KeyError,e:
+            logger.warning('cannot find "Join_Path" for job %s' % o.jid)
+
+        ## - job submission(creation?) time 
+        try:
+           o.t_submit = int(j['ctime'])
+        except KeyError,e:
+            logger.warning('cannot find "ctime" for job %s' % o.jid)
  
-        # if there is only one JobInfo block, the data is not put into a list
-        # to make it consistent, we put data into a list
-        if not isinstance( cjobs, list ):
-            cjobs = [ cjobs ]
-
-        return cjobs
+        ## - job queue time
+        try:
+           o.t_queue  = int(j['qtime'])
+        except KeyError,e:
+            logger.warning('cannot find "qtime" for job %s' % o.jid)
+
+        ## - job start time 
+        try:
+            o.t_start = int( j['start_time'] )
+        except KeyError,e:
+            logger.warning('cannot find "start_time" for job %s' % o.jid)
+
+        ## - job complete time 
+        try:
+            o.t_finish = int( j['comp_time'] )
+        except KeyError,e:
+            logger.warning('cannot find "comp_time" for job %s' % o.jid)
+
+    def __read_logs__(imap):
+        '''parse the log files not in the cache using the imap function, and yield the log
+           files in order together with their lists of Jobinfo dictionaries'''
+
+        cached = {}
+        nparts = {}
+        parts  = []
+        for f in xmlfiles:
+            if cache is not None:
+                cached[f] = cache.get(f)
+            if cached.get(f) is None:
+                if nprocs > 1:
+                    p = [ (f, beg, end) for beg, end in split_torque_log(f, nprocs) ]
+                else:
+                    p = [ (f, 0, None) ]
+                nparts[f] = len(p)
+                parts    += p
+
+        logger.debug('parsing %d logfiles in %d parts' % (len(nparts), len(parts)))
+
+        results = imap(_read_torque_log_part, parts)
+        for f in xmlfiles:
+            cjobs = cached.get(f)
+            if cjobs is None:
+                cjobs = []
+                for i in xrange(nparts[f]):
+                    cjobs += results.next()
+                if cache is not None:
+                    cache.put(f, cjobs)
+            yield f, cjobs
 
     ## get list of XML files corresponding to the jobs from the given date 
-    xmlfiles = glob.glob( os.path.join(logdir, date) + '*' )
+    if isinstance(date, basestring):
+        date = [ date ]
+
+    xmlfiles = []
+    for d in date:
+        xmlfiles += glob.glob( os.path.join(logdir, d) + '*' )
 
-    jlist = []
+    jlist = JobIndex()
+
+    strings = {}
 
     logger = getMyLogger(os.path.basename(__file__))
 
     if debug:
         logger.setLevel(logging.DEBUG)
 
-    for f in xmlfiles:
-
-        logger.debug('parsing logfile: %s' % f)
-
-        cjobs = __readfix_xml__(f)
-
-        for j in cjobs:
-
-            o = Job( jid      = j['Job_Id'],                  # torque job id
-                     jname    = None,                         # torque job name
-                     jstat    = None,                         # torque job status
-                     jec      = None,                         # job exit code
-                     cstat    = 'unknown',                    # category status interpreted from jec 
-                     uid      = None,                         # job owner
-                     gid      = None,                         # job owner's group id
-                     queue    = None,                         # job queue
-                     rmem     = 0,                            # requested memory in byte 
-                     rwtime   = 0,                            # requested wall-clock time in second
-                     htypes   = None,                         # the Job's Hold_Types 
-                     jpath    = None,                         # the Job's Join_Path 
-                     cmem     = None,                         # consumed physical memory in byte
-                     cvmem    = None,                         # consumed virtual memory in byte
-                     cwtime   = None,                         # consumed wall-clock time in second
-                     cctime   = None,                         # consumed CPU time in second
-                     node     = None,                         # compute node host
-                     t_submit = None,                         # timestamp for job being submitted to Torque
-                     t_queue  = None,                         # timestamp for job being scheduled in the queue 
-                     t_start  = None,                         # timestamp for job being started on execution node 
-                     t_finish = None                          # timestamp for job being completed 
-                   )
-           
-            ## handles the retried jobs (seperate entry in log file with same job id)
-            is_newjob = True
-            try:
-                o = jlist[ jlist.index(o) ]
-                is_newjob = False
-                logger.warning('job already presented in list: %s' % o.jid)
-            except:
-                pass
- 
-            ## attributes may not be available 
-            ## - resource requirement
-            try:
-                o.jname  = j['Job_Name']
-            except KeyError,e:
-                logger.warning('cannot find "Job_Name" for job %s' % o.jid)
-
-            ## - resource requirement
-            try:
-                o.rmem   = __convert_memory__( j['Resource_List']['mem'] )
-                o.rwtime = int( j['Resource_List']['walltime'] )
-            except KeyError,e:
-                logger.warning('cannot find "Resource_List" for job %s' % o.jid)
-            except TypeError,e:
-                logger.warning('empty "Resource_List" for job %s' % o.jid)
-            
-            ## - resource consumption
-            try:
-                o.cmem   = __convert_memory__( j['resources_used']['mem']  )
-                o.cvmem  = __convert_memory__( j['resources_used']['vmem'] )
-                o.cwtime = int( j['resources_used']['walltime'] )
-                o.cctime = int( j['resources_used']['cput'] )
-
-                if o.cctime > o.cwtime:
-                    logger.warning('Job %s: CPU time consumption (%d) > wallclock time consumption (%d)' % (o.jid, o.cctime, o.cwtime))
-
-            except KeyError,e:
-                logger.warning('cannot find "resources_used" for job %s' % o.jid)
-
-            ## - job exit status 
-            try:
-                o.jec   = int( j['exit_status'] )
-                o.cstat = interpret_job_ec( o.jec ) 
-            except KeyError,e:
-                logger.warning('cannot find "exit_status" for job %s' % o.jid)
-
-            ## - job execution host 
-            try:
-                o.node = j['exec_host']
-            except KeyError,e:
-                logger.warning('cannot find "exec_host" for job %s' % o.jid)
-
-            ## - job state 
-            try:
-                o.jstat = j['job_state']
-            except KeyError,e:
-                logger.warning('cannot find "job_state" for job %s' % o.jid)
-
-            ## - job owner
-            try:
-               o.uid = j['Job_Owner'].split('@')[0]
-            except KeyError,e:
-                logger.warning('cannot find "Job_Owner" for job %s' % o.jid)
-
-            ## - job owner's group
-            try:
-               o.gid = j['egroup']
-            except KeyError,e:
-                logger.warning('cannot find "egroup" for job %s' % o.jid)
-
-            ## - job queue 
-            try:
-               o.queue = j['queue']
-            except KeyError,e:
-                logger.warning('cannot find "queue" for job %s' % o.jid)
-
-            ## - job Hold_Types 
-            try:
-               o.htypes = j['Hold_Types']
-            except KeyError,e:
-                logger.warning('cannot find "Hold_Types" for job %s' % o.jid)
-
-            ## - job Join_Path
-            try:
-               o.jpath = j['Join_Path']
-            except KeyError,e:
-                logger.warning('cannot find "Join_Path" for job %s' % o.jid)
-
-            ## - job submission(creation?) time 
-            try:
-               o.t_submit = int(j['ctime'])
-            except KeyError,e:
-                logger.warning('cannot find "ctime" for job %s' % o.jid)
- 
-            ## - job queue time
-            try:
-               o.t_queue  = int(j['qtime'])
-            except KeyError,e:
-                logger.warning('cannot find "qtime" for job %s' % o.jid)
-
-            ## - job start time 
-            try:
-                o.t_start = int( j['start_time'] )
-            except KeyError,e:
-                logger.warning('cannot find "start_time" for job %s' % o.jid)
-
-            ## - job complete time 
-            try:
-                o.t_finish = int( j['comp_time'] )
-            except KeyError,e:
-                logger.warning('cannot find "comp_time" for job %s' % o.jid)
+    if offsets is not None:
+        offsets.retain(xmlfiles)
+        for f in xmlfiles:
+            beg = offsets.begin(f)
+            logger.debug('parsing logfile: %s from offset %d' % (f, beg))
+            offsets.mark(f, parse_torque_log(f, __update_job__, beg, complete=True))
+    elif nprocs > 1 or cache is not None:
+        pool = None
+        imap = itertools.imap
+        if nprocs > 1:
+            logger.debug('parsing logfiles with %d processes' % nprocs)
+            pool = multiprocessing.Pool(nprocs)
+            imap = pool.imap
+        try:
+            for f, cjobs in __read_logs__(imap):
+                logger.debug('merging jobs from logfile: %s' % f)
+                for j in cjobs:
+                    __update_job__(j)
+        except:
+            if pool:
+                pool.terminate()
+            raise
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+    else:
+        for f in xmlfiles:
+            logger.debug('parsing logfile: %s' % f)
+            parse_torque_log(f, __update_job__)
 
-            if is_newjob:
-                jlist.append( o )
-
-    return jlist
+    return jlist.jobs()
 
 def get_mentat_node_properties(debug=False):
     '''get memtat node properties (memory, ncores, network, no. active VNC sessions)'''
@@ -346,162 +981,166 @@ def get_mentat_node_properties(debug=False):
 
     return nodes
 
-def get_cluster_node_properties(node_domain_suffix='dccn.nl', debug=False):
-    '''parse pbsnodes -a to get node properties'''
-
-    logger = getMyLogger(os.path.basename(__file__))
-
-    if debug:
-        logger.setLevel(logging.DEBUG)
+## command giving the CPU speed scale factor of the nodes
+NODE_SPEED_CMD = 'hpcutil cluster config | grep NODECFG | grep SPEED | awk "{print $1 $2}"'
 
-    s = Shell(debug=False)
+## command giving the properties of the nodes
+NODE_PROPERTIES_CMD = 'pbsnodes -a'
 
-    ## get scale factor for node speed
-    cmd = 'hpcutil cluster config | grep NODECFG | grep SPEED | awk "{print $1 $2}"'
-    rc, output, m = s.cmd1(cmd, allowed_exit=[0,255], timeout=300)
+def parse_node_speeds(lines):
+    '''parse the NODECFG lines of the cluster config into a dictionary of the CPU speed scale factor per node'''
 
     speeds = {}
     re_node_speed = re.compile('^NODECFG\[(.*)\]\s+SPEED=(\S+)$')
-    if rc == 0:
-        for l in output.split('\n'):
-            l = l.strip()
-            m = re_node_speed.match(l)
-            if m:
-                speeds[m.group(1)] = float(m.group(2))
+    for l in lines:
+        l = l.strip()
+        m = re_node_speed.match(l)
+        if m:
+            speeds[m.group(1)] = float(m.group(2))
 
-    ## get node information 
-    nodes = []
+    return speeds
 
-    cmd = 'pbsnodes -a'
-    s = Shell(debug=False)
-    rc, output, m = s.cmd1(cmd, allowed_exit=[0,255], timeout=300)
+def parse_node_properties(lines, node_domain_suffix='dccn.nl'):
+    '''parse the output lines of pbsnodes -a into a list of Node objects'''
 
-    if rc != 0:
-        logger.error('command %s return non-exit code: %d' % (cmd, rc))
-    else:
-        re_host = re.compile('^(\S+)$')
-        re_jobs = re.compile('^\s+jobs\s+\=\s+(\S+)$')
-        re_stat = re.compile('^\s+state\s+\=\s+(\S+)$')
-        re_np   = re.compile('^\s+np\s+\=\s+(\d+)$')
-        re_ngp  = re.compile('^\s+gpus\s+\=\s+(\d+)$')
-        re_prop = re.compile('^\s+properties\s+\=\s+(\S+)$')
-        re_mem  = re.compile('^ram(\d+)gb$')
-        re_net  = re.compile('^network(\S+)$')
+    nodes = []
 
-        output = output.split('\n')
+    re_host = re.compile('^(\S+)$')
+    re_jobs = re.compile('^\s+jobs\s+\=\s+(\S+)$')
+    re_stat = re.compile('^\s+state\s+\=\s+(\S+)$')
+    re_np   = re.compile('^\s+np\s+\=\s+(\d+)$')
+    re_ngp  = re.compile('^\s+gpus\s+\=\s+(\d+)$')
+    re_prop = re.compile('^\s+properties\s+\=\s+(\S+)$')
+    re_mem  = re.compile('^ram(\d+)gb$')
+    re_net  = re.compile('^network(\S+)$')
 
-        n = None
-        for l in output:
+    n = None
+    for l in lines:
 
-            l = l.rstrip()
+        l = l.rstrip()
 
-            m = re_host.match(l)
-            if m:
-                n = Node(host          = m.group(1),  # hostname
-                         stat          = 'free',      # state
-                         ncores        = 1,           # ncores
-                         ncores_idle   = 1,           # ncores idling
-                         ncores_inter  = 0,           # ncores running interactive jobs 
-                         ncores_matlab = 0,           # ncores running batch-mode matlab jobs 
-                         ncores_vgl    = 0,           # ncores running vgl jobs
-                         ncores_batch  = 0,           # ncores running batch jobs
-                         cpu_type      = '',          # CPU type
-                         cpu_speed     = 1.0,         # CPU speed scale 
-                         mem           = 1,           # memory total
-                         memleft       = 1,           # memory left
-                         memleft_c     = 1,           # avg. memory left per core
-                         ngpus         = 0,           # number of GPUs
-                         net           = '',          # network connectivity
-                         interactive   = False,       # node allowing interactive jobs 
-                         matlab        = False,       # node allowing matlab batch jobs 
-                         vgl           = False,       # node allowing VirtualGL jobs 
-                         batch         = False,       # node allowing batch jobs 
-                         props         = [],          # other queue properties
-                         jobs          = {})          # jobs and allocated core ids
-                continue
+        m = re_host.match(l)
+        if m:
+            n = Node(host          = m.group(1),  # hostname
+                     stat          = 'free',      # state
+                     ncores        = 1,           # ncores
+                     ncores_idle   = 1,           # ncores idling
+                     ncores_inter  = 0,           # ncores running interactive jobs 
+                     ncores_matlab = 0,           # ncores running batch-mode matlab jobs 
+                     ncores_vgl    = 0,           # ncores running vgl jobs
+                     ncores_batch  = 0,           # ncores running batch jobs
+                     cpu_type      = '',          # CPU type
+                     cpu_speed     = 1.0,         # CPU speed scale 
+                     mem           = 1,           # memory total
+                     memleft       = 1,           # memory left
+                     memleft_c     = 1,           # avg. memory left per core
+                     ngpus         = 0,           # number of GPUs
+                     net           = '',          # network connectivity
+                     interactive   = False,       # node allowing interactive jobs 
+                     matlab        = False,       # node allowing matlab batch jobs 
+                     vgl           = False,       # node allowing VirtualGL jobs 
+                     batch         = False,       # node allowing batch jobs 
+                     props         = [],          # other queue properties
+                     jobs          = {})          # jobs and allocated core ids (as array of unsigned short)
+            continue
  
-            m = re_stat.match(l)
-            if m:
-                n.stat = m.group(1)
-                continue
+        m = re_stat.match(l)
+        if m:
+            n.stat = m.group(1)
+            continue
  
-            m = re_np.match(l)
-            if m:
-                n.ncores      = int(m.group(1))
-                n.ncores_idle = n.ncores 
-                continue
+        m = re_np.match(l)
+        if m:
+            n.ncores      = int(m.group(1))
+            n.ncores_idle = n.ncores 
+            continue
  
-            m = re_prop.match(l)
-            if m:
-                data = m.group(1).split(',')
-
-                ## TODO: find a better way to get CPU type, as here
-                ##       the implementation assumes the first 2 properties
-                ##       are always "cpu brand" and "cpu model". For example,
-                ##       
-                ##           properties = intel,e5-2680
-                ##
-                ##       or
-                ##           properties = amd,epyc7351
-                ##
-                n.cpu_type = ' '.join(data[0:2])
-
-                ## try to get the CPU speed factor if available
-                try:
-                    n.cpu_speed = speeds[n.host]
-                except KeyError, e:
-                    pass
+        m = re_prop.match(l)
+        if m:
+            data = m.group(1).split(',')
+
+            ## TODO: find a better way to get CPU type, as here
+            ##       the implementation assumes the first 2 properties
+            ##       are always "cpu brand" and "cpu model". For example,
+            ##       
+            ##           properties = intel,e5-2680
+            ##
+            ##       or
+            ##           properties = amd,epyc7351
+            ##
+            n.cpu_type = ' '.join(data[0:2])
+
+            for d in data[2:]:
+                mm = re_mem.match(d)
+                if mm:
+                    n.mem     = int( mm.group(1) )
+                    n.memleft = n.mem
+                    continue
+                mm = re_net.match(d)
+                if mm:
+                    n.net = mm.group(1)
+                    continue
+
+                n.props.append(d)
+
+            ## update job type support according to node properties
+            n.interactive = 'interactive' in n.props
+            n.matlab      = 'matlab'      in n.props
+            n.vgl         = 'vgl'         in n.props
+            n.batch       = 'batch'       in n.props
 
-                for d in data[2:]:
-                    mm = re_mem.match(d)
-                    if mm:
-                        n.mem     = int( mm.group(1) )
-                        n.memleft = n.mem
-                        continue
-                    mm = re_net.match(d)
-                    if mm:
-                        n.net = mm.group(1)
-                        continue
+            continue
 
-                    n.props.append(d)
+        m = re_jobs.match(l)
+        if m:
+            #jobs = 0-3/18316136[3].dccn-l029.dccn.nl,1,4-7/18316136[4].dccn-l029.dccn.nl,...
+            for job_str in m.group(1).replace(node_domain_suffix+',', node_domain_suffix+':').split(':'):
+                job_data = job_str.split('/')
+                job_id   = job_data[1].split('.')[0]
+                if job_id not in n.jobs:
+                    n.jobs[job_id] = array('H')
+                for id_data in job_data[0].split(','):
+                    id_beg = int(id_data.split('-')[0])
+                    id_end = int(id_data.split('-')[-1]) + 1
+                    n.jobs[job_id].extend(xrange(id_beg, id_end))
+            continue
+            
+        m = re_ngp.match(l)
+        if m:
+            n.ngpus = int( m.group(1) )
+            continue
 
-                ## update job type support according to node properties
-                n.interactive = 'interactive' in n.props
-                n.matlab      = 'matlab'      in n.props
-                n.vgl         = 'vgl'         in n.props
-                n.batch       = 'batch'       in n.props
+        if l == '':
+            if n not in nodes: ## avoid duplicat node entry
+                n.memleft_c = float( n.mem / n.ncores )
+                nodes.append( n )
+            continue
 
-                continue
+    return nodes
 
-            m = re_jobs.match(l)
-            if m:
-                #jobs = 0-3/18316136[3].dccn-l029.dccn.nl,1,4-7/18316136[4].dccn-l029.dccn.nl,...
-                for job_str in m.group(1).replace(node_domain_suffix+',', node_domain_suffix+':').split(':'):
-                    job_data = job_str.split('/')
-                    job_id   = job_data[1].split('.')[0]
-                    if job_id not in n.jobs.keys():
-                        n.jobs[job_id] = []
-                    for id_data in job_data[0].split(','):
-                        id_beg = int(id_data.split('-')[0])
-                        id_end = int(id_data.split('-')[-1]) + 1
-                        n.jobs[job_id] += range(id_beg, id_end)
-                continue
-                
-            m = re_ngp.match(l)
-            if m:
-                n.ngpus = int( m.group(1) )
-                continue
+def set_node_speeds(nodes, speeds):
+    '''set the CPU speed scale factor of the nodes given in speeds (see parse_node_speeds), returns the nodes'''
+    for n in nodes:
+        try:
+            n.cpu_speed = speeds[n.host]
+        except KeyError, e:
+            pass
+    return nodes
 
-            if l == '':
-                if n not in nodes: ## avoid duplicat node entry
-                    n.memleft_c = float( n.mem / n.ncores )
-                    nodes.append( n )
-                continue
+def get_cluster_node_properties(node_domain_suffix='dccn.nl', debug=False):
+    '''parse pbsnodes -a to get node properties'''
 
-#        for n in nodes:
-#            logger.debug(repr(n)) 
+    lv = logging.ERROR
+    if debug:
+        lv = logging.DEBUG
 
-    return nodes
+    ## the node speeds and properties are probed in parallel
+    probes = ProbeRunner(lv=lv)
+    probes.add('speeds', NODE_SPEED_CMD, parse_node_speeds, default={})
+    probes.add('nodes', NODE_PROPERTIES_CMD, lambda lines:parse_node_properties(lines, node_domain_suffix), default=[])
+    r = probes.run()
+
+    return set_node_speeds(r['nodes'], r['speeds'])
 
 def get_fs(s_cmd, debug=False):
     '''run cluster-faireshare to get current fairshare per USER/GROUP/CLASS/QoS'''
@@ -562,25 +1201,25 @@ def get_fs(s_cmd, debug=False):
                         fs[k][re.sub('\*$','',data[0])] = float(data[1])
     return fs
 
-def get_qstat_jobs(s_cmd, node_domain_suffix='dccn.nl', debug=False):
-    '''run cluster-qstat to get all job status and convert the output into job info dictionary'''
-
-    print s_cmd
+def parse_qstat_jobs(lines, node_domain_suffix='dccn.nl'):
+    '''parse the output lines of cluster-qstat into a dictionary keyed by the job state with a
+       JobIndex of the jobs in that state as value'''
 
     def __proc_walltime__(mytime):
         '''convert walltime to sum of minutes'''
         minutes = int(mytime.split(':')[0]) * 60 + int(mytime.split(':')[1])
         return minutes
 
+    def __apply_domain_suffix__(node_hostname):
+        host = node_hostname.split('/')[0]
+        if host != '--':
+            host += '.' + node_domain_suffix
+        return host
+
     logger = getMyLogger(os.path.basename(__file__))
-    if debug:
-        logger.setLevel(logging.DEBUG)
 
     jlist = {}
 
-    s = Shell(debug=False)
-    rc, output, m = s.cmd1(s_cmd, allowed_exit=[0,255], timeout=300)
-
     re_jinfo  = re.compile ( '^([0-9\[\]]+)\.\S+\s+'      +    # job id
                              '(\w+)\s+'                   +    # user id
                              '(\w+)\s+'                   +    # queue name
@@ -595,46 +1234,55 @@ def get_qstat_jobs(s_cmd, node_domain_suffix='dccn.nl', debug=False):
                              '(.*)$' )                         # computer node and session
                              #'((((dccn-c\d+)/(\d+\+?))|-{2,}){1,})$' )   # computer node and session
 
-    if rc != 0:
-        logger.error('command %s return non-exit code: %d' % (s_cmd, rc))
-    else:
+    for l in lines:
+        l = l.strip()
+        m = re_jinfo.match(l)
 
-        def __apply_domain_suffix__(node_hostname):
-            host = node_hostname.split('/')[0]
-            if host != '--':
-                host += '.' + node_domain_suffix
-            return host
+        if m:
+            nodelist = []
+            if m.group(12) != '--':
+                nodelist = map( lambda x:__apply_domain_suffix__(x), m.group(12).split('+'))
+
+            j = Job( jid   = m.group(1)               ,
+                     uid   = m.group(2)               ,
+                     queue = m.group(3)               ,
+                     jname = m.group(4)               ,
+                     sid   = m.group(5)               ,
+                     nds   = m.group(6)               ,
+                     tsk   = m.group(7)               ,
+                     rmem  = int(m.group(8))          ,
+                     rtime = __proc_walltime__(m.group(9)),
+                     jstat = m.group(10)              ,
+                     ctime = m.group(11)              ,
+                     node  = nodelist                 )
+
+            if j.jstat not in jlist:
+                jlist[j.jstat] = JobIndex()
+
+            jlist[j.jstat].add(j)
+        else:
+            logger.warning('qstat line not parsed: %s' % l)
 
-        for l in output.split('\n'):
-            l = l.strip()
-            m = re_jinfo.match(l)
+    return jlist
 
-            if m:
-                nodelist = []
-                if m.group(12) != '--':
-                    nodelist = map( lambda x:__apply_domain_suffix__(x), m.group(12).split('+'))
-
-                j = Job( jid   = m.group(1)               ,
-                         uid   = m.group(2)               ,
-                         queue = m.group(3)               ,
-                         jname = m.group(4)               ,
-                         sid   = m.group(5)               ,
-                         nds   = m.group(6)               ,
-                         tsk   = m.group(7)               ,
-                         rmem  = int(m.group(8))          ,
-                         rtime = __proc_walltime__(m.group(9)),
-                         jstat = m.group(10)              ,
-                         ctime = m.group(11)              ,
-                         node  = nodelist                 )
-
-                if j.jstat not in jlist.keys():
-                    jlist[j.jstat] = []
-
-                jlist[j.jstat].append(j)
-            else:
-                logger.warning('qstat line not parsed: %s' % l)
+def get_qstat_jobs(s_cmd, node_domain_suffix='dccn.nl', debug=False):
+    '''run cluster-qstat to get all job status and convert the output into job info dictionary,
+       the dictionary is keyed by the job state with a JobIndex of the jobs in that state as value'''
 
-    return jlist
+    print s_cmd
+
+    logger = getMyLogger(os.path.basename(__file__))
+    if debug:
+        logger.setLevel(logging.DEBUG)
+
+    s = Shell(debug=False)
+    rc, output, m = s.cmd1(s_cmd, allowed_exit=[0,255], timeout=300)
+
+    if rc != 0:
+        logger.error('command %s return non-exit code: %d' % (s_cmd, rc))
+        return {}
+
+    return parse_qstat_jobs(output.split('\n'), node_domain_suffix)
 
 def get_job_nprocs(s_cmd, job_id, node_domain_suffix='dccn.nl', debug=False):
     """get processor allocation of given job"""
@@ -663,20 +1311,17 @@ def get_job_nprocs(s_cmd, job_id, node_domain_suffix='dccn.nl', debug=False):
 
     return hprocs
 
-def get_matlab_license_usage(s_cmd, node_domain_suffix='dccn.nl', debug=False):
-    """get matlab license usage of DCCN"""
+def parse_matlab_license_usage(lines, node_domain_suffix='dccn.nl'):
+    """parse the output lines of the matlab license probe into a list of Job objects, one per license in use"""
     
     licenses = []
         
     re_pkg_header = re.compile('^package\s+(\S+):\s+.*')
     re_lic = re.compile('^\|\s+([a-z]+)\s+\|\s+(\S+)\s+\|.*')    
 
-    s = Shell(debug=False)
-    rc, output, m = s.cmd1(s_cmd, allowed_exit=[0,255], timeout=300)
-    
     pkg = None
     i = 0
-    for l in output.split('\n'):
+    for l in lines:
         
         l.strip()
         m = re_pkg_header.match(l)
@@ -695,3 +1340,11 @@ def get_matlab_license_usage(s_cmd, node_domain_suffix='dccn.nl', debug=False):
         i += 1
         
     return licenses
+
+def get_matlab_license_usage(s_cmd, node_domain_suffix='dccn.nl', debug=False):
+    """get matlab license usage of DCCN"""
+
+    s = Shell(debug=False)
+    rc, output, m = s.cmd1(s_cmd, allowed_exit=[0,255], timeout=300)
+
+    return parse_matlab_license_usage(output.split('\n'), node_domain_suffix)
@@ -5,6 +5,7 @@ from subprocess import Popen, PIPE
 import logging
 import inspect
 import time
+import threading
 import datetime 
 import re 
 import math 
@@ -12,6 +13,7 @@ import locale
 import ConfigParser
 import StringIO
 import gzip
+import json
 import pycurl
 
 import sys
@@ -68,20 +70,47 @@ def getMySQLConnector(host,uid,passwd,db):
     return cnx
 
 # a class for curl callback 
-class CURLCallback:
+class CURLCallback(object):
     def __init__(self):
-        self.header   = ''
-        self.contents = ''
+        self.header = ''
+        ## the body is kept in chunks, and joined once when the contents are asked for
+        self._body  = []
+
+    @property
+    def contents(self):
+        if len(self._body) > 1:
+            self._body = [''.join(self._body)]
+        return ''.join(self._body)
 
     def header_callback(self, buf):
         self.header = self.header + buf
 
     def body_callback(self, buf):
-        self.contents = self.contents + buf
+        self._body.append(buf)
 
     def progress_callback(self, download_t, download_d, upload_t, upload_d):
         logging.info('uploaded %d:%d', upload_d, upload_t)
 
+# a curl callback keeping only the lines of the body starting with one of the given prefixes
+class CURLLineFilter(CURLCallback):
+    def __init__(self, prefixes):
+        CURLCallback.__init__(self)
+        self.prefixes = tuple(prefixes)
+        ## the last, incomplete, line of the body received so far
+        self._tail = ''
+
+    @property
+    def contents(self):
+        if self._tail.startswith(self.prefixes):
+            self._body.append(self._tail)
+        self._tail = ''
+        return CURLCallback.contents.fget(self)
+
+    def body_callback(self, buf):
+        lines = (self._tail + buf).split('\n')
+        self._tail = lines.pop()
+        self._body.extend([ l + '\n' for l in lines if l.startswith(self.prefixes) ])
+
 def pushMetric(url, m):
     '''POST metric data'''
 
@@ -103,6 +132,200 @@ def pushMetric(url, m):
         logging.error('%s', t.header)
         logging.error('%s', t.contents)
 
+class OpenTSDBPusher:
+    '''pusher of metric data points to the OpenTSDB HTTP API (e.g. http://opentsdb:4242/api/put)
+
+       The data points are collected and POSTed in JSON arrays of up to batch_size points, once the
+       batch is full or flush_interval seconds after the previous POST; a timer POSTs the points
+       collected when no further point is pushed within the interval.  The content is compressed
+       by gzip if compress is True.  The same cURL handle is used for all POSTs, so that the HTTP
+       connection is kept alive between them.  Call close() to send out the remaining data points.
+
+       The points are POSTed with the "details" option, so that OpenTSDB reports the points it
+       rejects.  Only the points rejected for a transient reason (e.g. HBase asking to throttle),
+       or the whole batch if the POST itself fails, are POSTed again, up to retries times with an
+       exponential backoff starting at retry_backoff seconds.  The numbers of points stored and
+       failed are counted in nsent and nfailed, and logged by close().
+    '''
+
+    ## per data point errors of OpenTSDB worth a retry, the others (e.g. invalid metric name,
+    ## unparsable value) will fail again
+    TRANSIENT_ERRORS = re.compile(r'throttle|timeout|storage exception|unexpected exception', re.I)
+
+    def __init__(self, url, batch_size=50, flush_interval=10, compress=True, retries=3, retry_backoff=1):
+        if not re.search(r'[?&]details\b', url):
+            url += '&details' if '?' in url else '?details'
+
+        self.url            = url
+        self.batch_size     = batch_size
+        self.flush_interval = flush_interval
+        self.compress       = compress
+        self.retries        = retries
+        self.retry_backoff  = retry_backoff
+
+        self.nsent    = 0
+        self.nfailed  = 0
+        self.nretried = 0
+        self.errors   = {}
+
+        self._points = []
+        self._tflush = time.time()
+        self._curl   = None
+        self._timer  = None
+        self._lock   = threading.RLock()
+
+    def _handle(self):
+        '''get the cURL handle, the handle is created at the first POST'''
+        if self._curl is None:
+            headers = ['Content-Type: application/json']
+            if self.compress:
+                headers.append('Content-Encoding: gzip')
+
+            c = pycurl.Curl()
+            c.setopt(c.URL, self.url)
+            c.setopt(c.CONNECTTIMEOUT, 3)
+            c.setopt(c.TIMEOUT, 10)
+            c.setopt(c.HTTPHEADER, headers)
+            c.setopt(c.CUSTOMREQUEST, 'POST')
+            self._curl = c
+        return self._curl
+
+    def _fail(self, points, error):
+        '''count data points given up on'''
+        self.nfailed += len(points)
+        self.errors[error] = self.errors.get(error, 0) + len(points)
+
+    def _post(self, points):
+        '''POST the data points, returns the data points to be POSTed again'''
+
+        data = json.dumps(points)
+        if self.compress:
+            data = gzipContent(data)
+
+        t = CURLCallback()
+        c = self._handle()
+        c.setopt(c.HEADERFUNCTION, t.header_callback)
+        c.setopt(c.WRITEFUNCTION , t.body_callback)
+        c.setopt(c.POSTFIELDSIZE , len(data))
+        c.setopt(c.POSTFIELDS    , data)
+        try:
+            c.perform()
+        except pycurl.error, e:
+            logging.warning('cannot push %d data points to %s: %s', len(points), self.url, e)
+            self.close_handle()
+            return points
+
+        code = c.getinfo(pycurl.HTTP_CODE)
+        if code < 300:
+            self.nsent += len(points)
+            return []
+
+        try:
+            ## {"success": 49, "failed": 1, "errors": [{"datapoint": {...}, "error": "..."}]}
+            r = json.loads(t.contents)
+            errors = r['errors']
+            self.nsent += int(r['success'])
+        except (ValueError, TypeError, KeyError), e:
+            ## not a per data point report: the TSD is unavailable or the whole request is refused
+            logging.warning('cannot push %d data points to %s: HTTP %d', len(points), self.url, code)
+            if code >= 500:
+                return points
+            logging.error('%s', t.header)
+            logging.error('%s', t.contents)
+            self._fail(points, 'HTTP %d' % code)
+            return []
+
+        retry = []
+        for x in errors:
+            if self.TRANSIENT_ERRORS.search(x['error']):
+                retry.append(x['datapoint'])
+            else:
+                logging.debug('data point rejected: %s: %s', x['error'], json.dumps(x['datapoint']))
+                self._fail([x['datapoint']], x['error'])
+        return retry
+
+    def push(self, m):
+        '''add a data point, or a list of data points, as dictionary with metric, timestamp, value and tags'''
+        with self._lock:
+            if isinstance(m, dict):
+                self._points.append(m)
+            else:
+                self._points += m
+
+            dt = self.flush_interval - (time.time() - self._tflush)
+            if len(self._points) >= self.batch_size or dt <= 0:
+                self.flush()
+            elif self._points and self._timer is None:
+                self._timer = threading.Timer(dt, self._flush_timed)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush_timed(self):
+        '''the timer POSTing the points not followed by other points within the flush interval'''
+        with self._lock:
+            ## not a timer cancelled, or replaced by a later one, while waiting for the lock
+            if self._timer is not threading.current_thread():
+                return
+            self._timer = None
+            try:
+                self.flush()
+            except Exception, e:
+                logging.error('cannot push data points to %s: %s', self.url, e)
+
+    def _cancel(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def flush(self):
+        '''POST the collected data points'''
+        with self._lock:
+            self._cancel()
+            self._tflush = time.time()
+
+            while self._points:
+                points = self._points[:self.batch_size]
+                del self._points[:self.batch_size]
+
+                points = self._post(points)
+                for i in range(self.retries):
+                    if not points:
+                        break
+                    time.sleep(self.retry_backoff * 2**i)
+                    self.nretried += len(points)
+                    points = self._post(points)
+
+                if points:
+                    logging.error('give up pushing %d data points to %s', len(points), self.url)
+                    self._fail(points, 'retries exhausted')
+
+    def close_handle(self):
+        '''close the cURL handle, a new handle is created at the next POST; the timed POST is cancelled'''
+        self._cancel()
+        if self._curl is not None:
+            self._curl.close()
+            self._curl = None
+
+    def close(self):
+        '''send out the remaining data points, close the connection and log the numbers of data points pushed'''
+        self.flush()
+        self.close_handle()
+
+        logging.info('%d data points pushed to %s, %d failed, %d retried', self.nsent, self.url, self.nfailed, self.nretried)
+        for e, n in sorted(self.errors.items(), key=lambda x:-x[1]):
+            logging.warning('%d data points failed: %s', n, e)
+
+def getOpenTSDBPusher(cfg, url=None):
+    '''create the OpenTSDBPusher for the url, by default the URL_PUSH endpoint in the [OpenTSDB] section of the config'''
+    if url is None:
+        url = cfg.get('OpenTSDB','URL_PUSH')
+    return OpenTSDBPusher( url,
+                           batch_size     = cfg.getint('OpenTSDB','PUSH_BATCH_SIZE'),
+                           flush_interval = cfg.getfloat('OpenTSDB','PUSH_FLUSH_INTERVAL'),
+                           compress       = cfg.getboolean('OpenTSDB','PUSH_COMPRESS'),
+                           retries        = cfg.getint('OpenTSDB','PUSH_RETRIES'),
+                           retry_backoff  = cfg.getfloat('OpenTSDB','PUSH_RETRY_BACKOFF') )
+
 # a class make the dictionary hashable 
 class HashableDict(dict):
     def __hash__(self):
@@ -131,13 +354,25 @@ def getConfig(config_file='config.ini'):
     default_cfg = {
         # OpenTSDB config
         'URL_PUSH' : '',
+        'PUSH_BATCH_SIZE'    : '50',
+        'PUSH_FLUSH_INTERVAL': '10',
+        'PUSH_COMPRESS'      : 'true',
+        'PUSH_RETRIES'       : '3',
+        'PUSH_RETRY_BACKOFF' : '1',
         # Torque configuration 
         'DB_DATA_DIR'        : '/var/log/torque/torquemon_db',
         'TORQUE_LOG_DIR'     : '/home/common/torque/job_logs',
         'TORQUE_BATCH_QUEUES': 'short,medium,long',
+        'TORQUE_LOG_NPROCS'  : '1',
+        'TORQUE_LOG_STATE'   : '/var/log/torque/torquemon_db/torque_log_state.json',
+        'TORQUE_LOG_CACHE_DIR' : '',
+        'TORQUE_LOG_CACHE_SIZE': '1024',
+        'ACCT_TIME_RESOLUTION' : '3600',
+        'ACCT_MAX_WALLTIME'    : '604800',
         'BIN_QSTAT_ALL'      : 'hpcutil cluster qstat',
         'BIN_FSHARE_ALL'     : '',
         'BIN_CLUSTER_MATLAB' : 'hpcutil cluster matlablic',
+        'PROBE_DEADLINE'     : '300',
         'NOTIFICATION_EMAILS': '',
         # Project database interface
         'PDB_USER'         : '',
@@ -147,8 +382,19 @@ def getConfig(config_file='config.ini'):
         # TSDB endpoints
         'OPENTSDB_HOST'      : 'opentsdb',
         'OPENTSDB_PORT'      : '9042',
+        'OPENTSDB_SPOOL_DIR' : '',
+        'PUSH_DEADLINE'      : '600',
+        'PUSH_CONCURRENCY'   : '4',
         'PROMETHEUS_GW_HOST' : 'gw-prometheus',
-        'PROMETHEUS_GW_PORT' : '9091'
+        'PROMETHEUS_GW_PORT' : '9091',
+        'PROMETHEUS_GW_SHARD_LABEL': '',
+        'PROMETHEUS_GW_STATE_DIR'  : '',
+        'PROMETHEUS_GW_REFRESH'    : '3600',
+        'PROMETHEUS_GW_COMPRESS'   : 'false',
+        # Prometheus exporter
+        'EXPORTER_PORT'      : '9700',
+        'EXPORTER_ADDR'      : '',
+        'EXPORTER_INTERVAL'  : '60'
     }
 
     config = ConfigParser.SafeConfigParser(default_cfg)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+import time
+import threading
+import logging
+
+from Common import getMyLogger
+
+from prometheus_client import Metric, start_http_server
+
+class ExportedRegistry:
+    '''the metrics in the registries of several collectors, as served by a MetricsExporter
+
+       The registry of each collector (e.g. ClusterStatistics) is collected with the lock of the
+       collector held, so that a scrape does not see the metrics of a collection half-way.
+    '''
+    def __init__(self, collectors):
+        self.collectors = collectors
+
+    def collect(self):
+        metrics = []
+        for c in self.collectors:
+            with c.lock:
+                metrics.extend(c.registry.collect())
+        return metrics
+
+    def restricted_registry(self, names):
+        '''get the registry of the samples with the given names, for the "name[]" query parameter'''
+        names = set(names)
+        metrics = []
+        for metric in self.collect():
+            samples = [ s for s in metric.samples if s[0] in names ]
+            if samples:
+                m = Metric(metric.name, metric.documentation, metric.type)
+                m.samples = samples
+                metrics.append(m)
+
+        class RestrictedRegistry:
+            def collect(self):
+                return metrics
+
+        return RestrictedRegistry()
+
+class MetricsExporter:
+    '''serves the metrics of collectors over HTTP, for Prometheus to scrape
+
+       The collectors are objects with a registry, a lock and a collectMetrics method replacing
+       the metrics in the registry, as ClusterStatistics and ClusterEnergyConsumption.  A thread
+       calls collectMetrics of every collector every interval seconds; the registries are served
+       at http://addr:port/metrics by the start_http_server of prometheus_client.
+    '''
+    def __init__(self, collectors, interval=60, port=9700, addr='', lv=logging.ERROR):
+
+        self.logger = getMyLogger(self.__class__.__name__)
+        self.logger.setLevel(lv)
+
+        self.collectors = collectors
+        self.interval   = interval
+        self.port       = port
+        self.addr       = addr
+
+        self._stop   = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        '''collect the metrics of all collectors once'''
+        for c in self.collectors:
+            t = time.time()
+            try:
+                c.collectMetrics()
+            except Exception, e:
+                self.logger.error('cannot collect metrics of %s: %s' % (c.__class__.__name__, e))
+            else:
+                self.logger.debug('metrics of %s collected in %.2f seconds' % (c.__class__.__name__, time.time() - t))
+
+    def _run(self):
+        '''the refresh thread, collections start every interval seconds or, if a collection takes
+           longer, as soon as the previous one is finished'''
+        while not self._stop.is_set():
+            t = time.time()
+            self.refresh()
+            self._stop.wait(max(0, self.interval - (time.time() - t)))
+
+    def start(self):
+        '''start serving the metrics and the refresh thread'''
+        start_http_server(self.port, addr=self.addr, registry=ExportedRegistry(self.collectors))
+        self.logger.info('serving metrics at %s:%d, refreshed every %s seconds' % (self.addr or '*', self.port, self.interval))
+
+        self._thread = threading.Thread(target=self._run, name='refresh')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''stop the refresh thread, after the collection in progress'''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def wait(self):
+        '''wait until the refresh thread stops'''
+        while self._thread is not None and self._thread.is_alive():
+            self._thread.join(1)
+
+def getMetricsExporter(collectors, cfg, lv=logging.ERROR):
+    '''create the MetricsExporter with the EXPORTER_INTERVAL, EXPORTER_PORT and EXPORTER_ADDR in the [MetricsExporter] section of the config'''
+    return MetricsExporter( collectors,
+                            interval = cfg.getfloat('MetricsExporter','EXPORTER_INTERVAL'),
+                            port     = cfg.getint('MetricsExporter','EXPORTER_PORT'),
+                            addr     = cfg.get('MetricsExporter','EXPORTER_ADDR'),
+                            lv       = lv )
@@ -8,9 +8,69 @@ from prometheus_client.parser import text_string_to_metric_families
 import potsdb
 import datetime
 import logging
+import json
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from utils.Cluster import *
 from utils.Common  import *
+from utils.Push    import *
+
+def spread_over_time_bins(t_beg, t_end, groups, values, resolution):
+    """spread the values of the time intervals over the time bins they overlap with
+
+    The i-th interval [t_beg[i], t_end[i]) (t_end[i] > t_beg[i]) belongs to the group groups[i]
+    (an integer), and carries the values values[0][i], values[1][i], ...  Each value is spread
+    over the time bins of resolution seconds in proportion to the overlap of the interval with
+    the bin, and summed up per group and bin.  It returns a dictionary keyed by the tuple of
+    (group, beginning time of the bin) with the list of the summed values.
+
+    The intervals are expanded into the bins with NumPy if it is available.
+    """
+
+    r = resolution
+
+    if numpy is None:
+        sums = {}
+        for i in xrange(len(t_beg)):
+            d = float(t_end[i] - t_beg[i])
+            b = t_beg[i] - t_beg[i] % r
+            while b < t_end[i]:
+                w = ( min(t_end[i], b + r) - max(t_beg[i], b) ) / d
+                s = sums.setdefault((groups[i], b), [0.0] * len(values))
+                for n, v in enumerate(values):
+                    s[n] += w * v[i]
+                b += r
+        return sums
+
+    if not len(t_beg):
+        return {}
+
+    t_beg  = numpy.asarray(t_beg , dtype=numpy.int64)
+    t_end  = numpy.asarray(t_end , dtype=numpy.int64)
+    groups = numpy.asarray(groups, dtype=numpy.int64)
+
+    ## expand the intervals into one element per pair of interval (i) and bin (b)
+    b_beg = t_beg // r
+    nbins = ( t_end - 1 ) // r - b_beg + 1
+    i = numpy.repeat(numpy.arange(len(t_beg)), nbins)
+    b = b_beg[i] + numpy.arange(len(i)) - numpy.repeat(numpy.cumsum(nbins) - nbins, nbins)
+    w = ( numpy.minimum(t_end[i], (b + 1) * r) - numpy.maximum(t_beg[i], b * r) ) / ( t_end - t_beg )[i].astype(float)
+
+    ## sum up per group and bin
+    b_min = int(b.min())
+    nb    = int(b.max()) - b_min + 1
+    keys, k = numpy.unique(groups[i] * nb + (b - b_min), return_inverse=True)
+    vsums = [ numpy.bincount(k, weights=w * numpy.asarray(v, dtype=float)[i]) for v in values ]
+
+    sums = {}
+    for n, key in enumerate(keys.tolist()):
+        sums[(key // nb, (key % nb + b_min) * r)] = [ float(s[n]) for s in vsums ]
+    return sums
 
 class MetricData:
     """data object for metric data"""
@@ -30,6 +90,64 @@ class MetricData:
             raise NotImplementedError
         return self.tags == other.tags
 
+class MetricAggregator:
+    """aggregator of metric data points keyed by the metric name and the tags
+
+    Data points of a metric with the same tags are reduced into one MetricData
+    using the reducer of the metric: 'sum', 'count', 'min' or 'max'.  It can be
+    used in place of the dictionary of MetricData lists, i.e.
+
+    key: metric name
+    value: [ MetricData_1, MetricData_2, ... ]
+    """
+
+    reducers = {'sum'  : lambda x, v: x + v,
+                'count': lambda x, v: x + 1,
+                'min'  : min,
+                'max'  : max}
+
+    def __init__(self, metrics=[], reducer='sum'):
+        self._data     = {}
+        self._reducers = {}
+        for m in metrics:
+            self.register(m, reducer)
+
+    def register(self, metric, reducer='sum'):
+        """register a metric with the reducer for the data points having the same tags"""
+        if reducer not in self.reducers:
+            raise ValueError('unknown reducer: %s' % reducer)
+        self._data.setdefault(metric, {})
+        self._reducers[metric] = reducer
+
+    def add(self, metric, tags, value):
+        """add a data point of the metric"""
+        data = self._data[metric]
+        k = frozenset(tags.iteritems())
+        try:
+            d = data[k]
+            d.value = self.reducers[self._reducers[metric]](d.value, value)
+        except KeyError:
+            if self._reducers[metric] == 'count':
+                value = 1
+            data[k] = MetricData(tags=tags, value=value)
+
+    def set(self, metric, tags, value):
+        """set the value of the data point of the metric, replacing the reduced value"""
+        self._data[metric][frozenset(tags.iteritems())] = MetricData(tags=tags, value=value)
+
+    def keys(self):
+        return self._data.keys()
+
+    def iteritems(self):
+        for m, data in self._data.iteritems():
+            yield m, data.values()
+
+    def __getitem__(self, metric):
+        return self._data[metric].values()
+
+    def __len__(self):
+        return sum(map(len, self._data.values()))
+
 class ClusterAccounting:
     """metrics collector for cluster utilisation accounting"""
     def __init__(self, config, lv=logging.ERROR):
@@ -40,23 +158,32 @@ class ClusterAccounting:
         ## load config file and global settings
         c = getConfig(config)
         self.TORQUE_LOG_DIR      = c.get('TorqueTracker','TORQUE_LOG_DIR')
+        self.TORQUE_LOG_NPROCS   = int(c.get('TorqueTracker','TORQUE_LOG_NPROCS'))
+        self.TORQUE_LOG_STATE    = c.get('TorqueTracker','TORQUE_LOG_STATE')
+        self.TORQUE_LOG_CACHE_DIR  = c.get('TorqueTracker','TORQUE_LOG_CACHE_DIR')
+        self.TORQUE_LOG_CACHE_SIZE = int(c.get('TorqueTracker','TORQUE_LOG_CACHE_SIZE'))
+        self.ACCT_TIME_RESOLUTION  = int(c.get('TorqueTracker','ACCT_TIME_RESOLUTION'))
+        self.ACCT_MAX_WALLTIME     = int(c.get('TorqueTracker','ACCT_MAX_WALLTIME'))
         self.BIN_QSTAT_ALL       = c.get('TorqueTracker','BIN_QSTAT_ALL')
         self.BIN_FSHARE_ALL      = c.get('TorqueTracker','BIN_FSHARE_ALL')
         self.TORQUE_BATCH_QUEUES = c.get('TorqueTracker','TORQUE_BATCH_QUEUES').split(',')
         
         self.OPENTSDB_HOST = c.get('MetricsPusher','OPENTSDB_HOST')
         self.OPENTSDB_PORT = int(c.get('MetricsPusher','OPENTSDB_PORT'))
+        self.OPENTSDB_SPOOL_DIR = c.get('MetricsPusher','OPENTSDB_SPOOL_DIR')
+        self.PUSH_DEADLINE = float(c.get('MetricsPusher','PUSH_DEADLINE'))
         
-        ## The registry contains metrics data in the following format
-        ##
-        ## key: metric name
-        ## value: [ MetricData_1, MetricData_2, ... ]
-        self.registry = {'hpc_acct_wtime_asked': [],
-                         'hpc_acct_wtime_used' : [],
-                         'hpc_acct_mem_asked'  : [],
-                         'hpc_acct_mem_used'   : [],
-                         'hpc_acct_ctime_used' : [],
-                         'hpc_acct_job_count'  : []}
+        ## The registry aggregates metrics data per metric name and tags,
+        ## see MetricAggregator
+        self.registry = MetricAggregator(['hpc_acct_wtime_asked',
+                                          'hpc_acct_wtime_used' ,
+                                          'hpc_acct_mem_asked'  ,
+                                          'hpc_acct_mem_used'   ,
+                                          'hpc_acct_ctime_used' ])
+        self.registry.register('hpc_acct_job_count', 'count')
+
+        ## offsets of the torque log files for the incremental collection
+        self.offsets = None
     
     def exportToFile(self, fpath):
         """export metrics in the registry to a file"""
@@ -68,6 +195,8 @@ class ClusterAccounting:
         return
 
     def pushMetrics(self, host=None, **kwargs):
+        """push metrics in the registry to openTSDB, by the given PushDispatcher (kwarg 'dispatcher')
+           or by a new one that is waited for; returns False if not all data points are sent out"""
         
         if not host:
             host = self.OPENTSDB_HOST
@@ -76,7 +205,11 @@ class ClusterAccounting:
         qsize=100000
         host_tag=True
         mps=0
+        burst=None
+        nconns=1
         check_host=True
+        timeout=self.PUSH_DEADLINE
+        dispatcher=None
 
         for k in kwargs.keys():
             if k == 'port':
@@ -86,60 +219,223 @@ class ClusterAccounting:
                 qsize = int(kwargs[k])
                 continue
             if k == 'host_tag':
-                host_tab = bool(kwargs[k])
+                host_tag = bool(kwargs[k])
                 continue
             if k == 'mps':
                 mps = int(kwargs[k])
                 continue
+            if k == 'burst':
+                burst = int(kwargs[k])
+                continue
+            if k == 'nconns':
+                nconns = int(kwargs[k])
+                continue
             if k == 'check_host':
                 check_host = bool(kwargs[k])
                 continue
+            if k == 'timeout':
+                timeout = float(kwargs[k])
+                continue
+            if k == 'dispatcher':
+                dispatcher = kwargs[k]
+                continue
+
+        spool = None
+        if self.OPENTSDB_SPOOL_DIR:
+            ## data points are kept on disk until the TSD accepts them, the ones not sent
+            ## within the deadline are sent by the next push
+            spool = self.OPENTSDB_SPOOL_DIR
+            check_host = False
+
+        def __done__(ok):
+            # the log files are tailed from the new offsets only once the data are sent out
+            if not ok:
+                self.logger.warning('not all data points are sent out to %s' % host)
+            elif self.offsets is not None:
+                self.saveState()
+
+        ## the connections are spread over the comma-separated list of hosts
+        t = OpenTSDBTelnetTransport(host.split(','), port=port, qsize=qsize, host_tag=host_tag, mps=mps, burst=burst,
+                                    nconns=nconns, check_host=check_host, spool=spool)
+
+        wait = dispatcher is None
+        if wait:
+            dispatcher = PushDispatcher(deadline=timeout, lv=self.logger.level)
+
+        name = dispatcher.add('%s:%d' % (host, port), t, done=__done__)
 
-        metrics = potsdb.Client(host, port=port, qsize=qsize, host_tag=host_tag, mps=mps, check_host=check_host)
-        
         # send data to openTSDB
         for m,d in self.registry.iteritems():
-            for x in d:
-                metrics.send(m, x.value, **x.tags)
+            dispatcher.push(name, [(m, x.value, x.tags) for x in d])
 
         # wait until data are being sent out
-        metrics.wait()
+        if wait:
+            return dispatcher.wait()
+        return True
 
-    def collectMetrics(self, date=None):
-        """collection metrics"""
+    def loadState(self, tmin=0):
+        """load the offsets of the torque log files and the data points of the previous incremental
+           collection from the state file, data points with timestamp before tmin are discarded"""
+
+        self.offsets = TorqueLogOffsets()
+        try:
+            f = open(self.TORQUE_LOG_STATE, 'r')
+            try:
+                state = json.load(f)
+            finally:
+                f.close()
+        except IOError, e:
+            self.logger.warning('cannot load state file %s: %s' % (self.TORQUE_LOG_STATE, e))
+            return
+        except ValueError, e:
+            self.logger.error('corrupted state file %s: %s' % (self.TORQUE_LOG_STATE, e))
+            return
+
+        self.offsets.update(state['offsets'])
+        for m, d in state['metrics'].iteritems():
+            for tags, value in d:
+                if tags['timestamp'] >= tmin:
+                    self.registry.set(m, tags, value)
+
+    def saveState(self):
+        """save the offsets of the torque log files and the data points to the state file"""
+
+        state = {'offsets': self.offsets, 'metrics': {}}
+        for m, d in self.registry.iteritems():
+            state['metrics'][m] = [ (x.tags, x.value) for x in d ]
+
+        ## write to a temporary file first, not to leave a partial state behind
+        fpath = self.TORQUE_LOG_STATE + '.tmp'
+        f = open(fpath, 'w')
+        try:
+            json.dump(state, f)
+        finally:
+            f.close()
+        os.rename(fpath, self.TORQUE_LOG_STATE)
+
+    def collectMetrics(self, date=None, incremental=False, spread=False):
+        """collection metrics
+
+           The data points are aggregated in time bins of ACCT_TIME_RESOLUTION seconds.  A job is
+           accounted to the bin in which it finished.  If spread is True, the consumed wall-clock
+           and CPU time of a job are spread over the bins in which the job was running instead,
+           assuming the CPU time is consumed at a constant rate.
+
+           In the incremental mode, only the jobs appended to the log files since the previous
+           incremental collection are parsed, and added to the data points of the previous
+           collection loaded from the state file, so that the data points are the running totals
+           of the time bins.  The log files of yesterday and today are tailed by default.
+           The state file is updated by pushMetrics.  The running totals are kept from a day, or
+           with spread ACCT_MAX_WALLTIME seconds if longer, before the first day.
+
+           Otherwise the data points are the totals of the jobs in the log files of the dates;
+           the usage of the jobs spread over the bins before the first day is left out, not to
+           overwrite the totals of the previous dates.  Spreading the usage of the jobs running
+           over several days needs the incremental mode, or all the dates collected at once.
+
+           The usage left out of the bins before the first day (or the running totals) is logged.
+        """
 
         if not date:
-            date = (datetime.date.today() - datetime.timedelta(1)).strftime('%Y%m%d')
+            today = datetime.date.today()
+            date  = [ (today - datetime.timedelta(1)).strftime('%Y%m%d') ]
+            if incremental:
+                date.append(today.strftime('%Y%m%d'))
+        elif isinstance(date, basestring):
+            date = [ date ]
+
+        tmin = time.mktime(datetime.datetime.strptime(min(date), '%Y%m%d').timetuple())
+        if incremental:
+            ## data points before the running totals are not updated anymore
+            window = 86400
+            if spread:
+                window = max(window, self.ACCT_MAX_WALLTIME)
+            tmin -= window
+            self.loadState(tmin)
+
+        ## cache of the parsed log files, for recollecting the metrics of the past dates
+        cache = None
+        if self.TORQUE_LOG_CACHE_DIR:
+            cache = TorqueLogCache(self.TORQUE_LOG_CACHE_DIR, self.TORQUE_LOG_CACHE_SIZE * 1024**2)
 
         self.logger.info('collecting data of jobs submitted on %s' % date)
-        jobs = get_complete_jobs(self.TORQUE_LOG_DIR, date, debug=(self.logger.level == logging.DEBUG) )
+        jobs = get_complete_jobs(self.TORQUE_LOG_DIR, date, debug=(self.logger.level == logging.DEBUG), nprocs=self.TORQUE_LOG_NPROCS, offsets=self.offsets, cache=cache )
         
-        for j in filter(lambda x:(x.cwtime and x.cmem and x.cctime), jobs):
+        jobs = filter(lambda x:(x.cwtime and x.cmem and x.cctime), jobs)
+
+        # the data point is timestamped in the middle of the time bin
+        r = self.ACCT_TIME_RESOLUTION
 
-            # TODO: make the time resolution configurable, currently it's hardcoded as 1 hour = 3600 seconds
-            ts = long(j.t_finish) - ( long(j.t_finish) % 3600 ) + 1800
+        ## jobs, wall-clock and CPU time left out as they are accounted to the time bins before tmin,
+        ## and the wall-clock and CPU time left out of the jobs spread over those bins
+        dropped = [0, 0, 0, 0., 0.]
+
+        kept = []
+        for j in jobs:
+
+            ts = long(j.t_finish) - ( long(j.t_finish) % r ) + r/2
+
+            ## the data points before tmin are not in the state of the incremental collection,
+            ## adding the job would overwrite the totals pushed before with the job alone
+            if ts < tmin:
+                dropped[0] += 1
+                dropped[1] += j.cwtime
+                dropped[2] += j.cctime
+                continue
+            kept.append(j)
 
             # TODO: convert gid to meaninful value?
             s = interpret_job_ec(j.jec)
             t  = {'gid':str(j.gid), 'uid':str(j.uid), 'jstat':s, 'jqueue':j.queue, 'timestamp': ts}
             
-            # construct data points for this job
-            data = {'hpc_acct_wtime_asked': MetricData(tags=t, value=j.rwtime),
-                    'hpc_acct_mem_asked'  : MetricData(tags=t, value=j.rmem),
-                    'hpc_acct_wtime_used' : MetricData(tags=t, value=j.cwtime),
-                    'hpc_acct_mem_used'   : MetricData(tags=t, value=j.cmem),
-                    'hpc_acct_ctime_used' : MetricData(tags=t, value=j.cctime),
-                    'hpc_acct_job_count'  : MetricData(tags=t, value=1)}
-            
-            # update registry
-            for m,d in data.iteritems():
-                try:
-                    idx = self.registry[m].index(d)
-                    self.registry[m][idx].value += d.value
-                except ValueError:
-                    self.registry[m].append(d)
-                except:
-                    pass
+            # update registry with data points of this job
+            self.registry.add('hpc_acct_wtime_asked', t, j.rwtime)
+            self.registry.add('hpc_acct_mem_asked'  , t, j.rmem)
+            self.registry.add('hpc_acct_mem_used'   , t, j.cmem)
+            self.registry.add('hpc_acct_job_count'  , t, 1)
+            if not spread:
+                self.registry.add('hpc_acct_wtime_used' , t, j.cwtime)
+                self.registry.add('hpc_acct_ctime_used' , t, j.cctime)
+
+        jobs = kept
+
+        if spread:
+            if numpy is None:
+                self.logger.warning('numpy not available, spreading job usage over time bins in pure python')
+
+            ## the jobs are grouped by the tags other than the timestamp, and
+            ## run from cwtime seconds before the finish time until the finish time
+            tags   = []
+            groups = []
+            gidx   = {}
+            for j in jobs:
+                k = (str(j.gid), str(j.uid), interpret_job_ec(j.jec), j.queue)
+                if k not in gidx:
+                    gidx[k] = len(tags)
+                    tags.append({'gid':k[0], 'uid':k[1], 'jstat':k[2], 'jqueue':k[3]})
+                groups.append(gidx[k])
+
+            t_end = [ long(j.t_finish) for j in jobs ]
+            t_beg = [ long(j.t_finish) - j.cwtime for j in jobs ]
+            sums  = spread_over_time_bins(t_beg, t_end, groups, [ [ j.cwtime for j in jobs ], [ j.cctime for j in jobs ] ], r)
+
+            for (g, tb), (wtime, ctime) in sums.iteritems():
+                ## data points before tmin are not updated, see above
+                if tb + r/2 < tmin:
+                    dropped[3] += wtime
+                    dropped[4] += ctime
+                    continue
+                t = dict(tags[g], timestamp=tb + r/2)
+                self.registry.add('hpc_acct_wtime_used' , t, wtime)
+                self.registry.add('hpc_acct_ctime_used' , t, ctime)
+
+        t_min = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(tmin))
+        if dropped[0]:
+            self.logger.warning('%d jobs finished before %s left out: wall-clock time %d s, CPU time %d s' %
+                                (dropped[0], t_min, dropped[1], dropped[2]))
+        if dropped[3] or dropped[4]:
+            self.logger.warning('usage of the jobs running before %s left out: wall-clock time %d s, CPU time %d s' %
+                                (t_min, dropped[3], dropped[4]))
                     
 class MatlabLicenseAccounting(ClusterAccounting):
     """metrics collector for matlab license usage"""
@@ -150,23 +446,18 @@ class MatlabLicenseAccounting(ClusterAccounting):
         ## load config file and global settings
         c = getConfig(config)
         self.BIN_CLUSTER_MATLAB = c.get('TorqueTracker','BIN_CLUSTER_MATLAB')       
-        self.registry = {'hpc_acct_matlab_license_usage':[]}
+        self.registry = MetricAggregator(['hpc_acct_matlab_license_usage'], reducer='count')
         
-    def collectMetrics(self, date=None):
-        """collection metrics"""
+    def collectMetrics(self, date=None, licenses=None):
+        """collection metrics, from the licenses as given by get_matlab_license_usage (or by a
+           ProbeRunner with parse_matlab_license_usage); the licenses are probed if not given"""
         now = time.time()
-        self.logger.debug('getting matlab license usage ...')
-        licenses = get_matlab_license_usage(self.BIN_CLUSTER_MATLAB)
+        if licenses is None:
+            self.logger.debug('getting matlab license usage ...')
+            licenses = get_matlab_license_usage(self.BIN_CLUSTER_MATLAB)
         m = 'hpc_acct_matlab_license_usage'
         for l in licenses:
-            d = MetricData(tags={'package': l.package, 'host':l.host, 'timestamp': now}, value=1)
-            try:
-                idx = self.registry[m].index(d)
-                self.registry[m][idx].value += d.value
-            except ValueError:
-                self.registry[m].append(d)
-            except:
-                pass
+            self.registry.add(m, {'package': l.package, 'host':l.host, 'timestamp': now}, 1)
 
 class ClusterStatistics:
     """metrics collector for cluster statistics"""
@@ -180,15 +471,40 @@ class ClusterStatistics:
         self.BIN_QSTAT_ALL       = c.get('TorqueTracker','BIN_QSTAT_ALL')
         self.BIN_FSHARE_ALL      = c.get('TorqueTracker','BIN_FSHARE_ALL')
         self.TORQUE_BATCH_QUEUES = c.get('TorqueTracker','TORQUE_BATCH_QUEUES').split(',')
+        self.PROBE_DEADLINE      = c.getfloat('TorqueTracker','PROBE_DEADLINE')
         
         self.PROMETHEUS_GW_HOST = c.get('MetricsPusher', 'PROMETHEUS_GW_HOST')
         self.PROMETHEUS_GW_PORT = c.get('MetricsPusher', 'PROMETHEUS_GW_PORT')
+        self.PUSH_DEADLINE      = float(c.get('MetricsPusher', 'PUSH_DEADLINE'))
+        self.PROMETHEUS_GW_SHARD_LABEL = c.get('MetricsPusher', 'PROMETHEUS_GW_SHARD_LABEL')
+        self.PROMETHEUS_GW_STATE_DIR   = c.get('MetricsPusher', 'PROMETHEUS_GW_STATE_DIR')
+        self.PROMETHEUS_GW_REFRESH     = c.getfloat('MetricsPusher', 'PROMETHEUS_GW_REFRESH')
+        self.PROMETHEUS_GW_COMPRESS    = c.getboolean('MetricsPusher', 'PROMETHEUS_GW_COMPRESS')
         
         self.registry = CollectorRegistry()
 
+        ## the gauges in the registry, created by the first collection and cleared by the next;
+        ## the registry is updated with the lock held
+        self.gauges = {}
+        self.lock   = threading.Lock()
+
         # maintain a list of nodes that are in status 'down'
         self.nodes_down = []
     
+    def getGauge(self, name, documentation, labelnames):
+        """get the gauge with the given name, it is created in the registry the first time"""
+        try:
+            return self.gauges[name]
+        except KeyError:
+            g = Gauge(name, documentation, labelnames, registry=self.registry)
+            self.gauges[name] = g
+            return g
+
+    def clearMetrics(self):
+        """remove the samples of the previous collection from the gauges"""
+        for g in self.gauges.values():
+            g.clear()
+
     def exportToFile(self, fpath):
         """export metrics in the registry to a file"""
         write_to_textfile(fpath, self.registry)
@@ -197,7 +513,9 @@ class ClusterStatistics:
     def getMetrics(self, name, **labels):
         """get latest value of a given metrics with name and labels"""
         
-        t = CURLCallback()
+        ## only the lines that may belong to the metric are kept from the response, and
+        ## only the metric families with the name are parsed
+        t = CURLLineFilter([name, '# HELP %s ' % name, '# TYPE %s ' % name])
         c = pycurl.Curl()
         c.setopt(c.URL, "http://%s:%s/metrics" % (self.PROMETHEUS_GW_HOST, self.PROMETHEUS_GW_PORT))
         c.setopt(c.CONNECTTIMEOUT, 3)
@@ -212,14 +530,19 @@ class ClusterStatistics:
         self.logger.debug('dump metrics from %s (HTTP CODE: %d)' % (self.PROMETHEUS_GW_HOST, code))
 
         m = []
-        for family in text_string_to_metric_families(t.contents):
+        for family in text_string_to_metric_families(t.contents, names=[name]):
             for sample in family.samples:
                 if sample[0] == name and all(item in sample[1].items() for item in labels.items()):
                     m.append(sample)
         return m
 
     def pushMetrics(self, endpoint=None, **kwargs):
-        """push metrics in the registry to the prometheus gateway"""
+        """push metrics in the registry to the prometheus gateway, or to each of a comma-separated
+           list of gateways, by the given PushDispatcher (kwarg 'dispatcher') or by a new one that
+           is waited for; returns False if the metrics are not pushed to all gateways
+
+           If PROMETHEUS_GW_SHARD_LABEL is set, the metrics are pushed in one group per value of
+           the label, and only the groups that changed since the last push are sent."""
 
         if not endpoint:
             endpoint = '%s:%s' % (self.PROMETHEUS_GW_HOST, self.PROMETHEUS_GW_PORT)
@@ -230,29 +553,78 @@ class ClusterStatistics:
         except:
             pass
 
-        push_to_gateway(endpoint, job=job, registry=self.registry)
-        return
+        timeout = self.PUSH_DEADLINE
+        try:
+            timeout = float(kwargs['timeout'])
+        except:
+            pass
+
+        dispatcher = kwargs.get('dispatcher')
+        wait = dispatcher is None
+        if wait:
+            dispatcher = PushDispatcher(deadline=timeout, lv=self.logger.level)
+
+        def __transport__(gw):
+            if not self.PROMETHEUS_GW_SHARD_LABEL:
+                return PushgatewayTransport(gw, job, compress=self.PROMETHEUS_GW_COMPRESS)
+
+            ## the digests of the groups last pushed are kept in a state file per gateway and job
+            state = None
+            if self.PROMETHEUS_GW_STATE_DIR:
+                state = os.path.join(self.PROMETHEUS_GW_STATE_DIR,
+                                     re.sub(r'[^\w.-]', '_', '%s_%s' % (gw, job)) + '.json')
+            return ShardedPushgatewayTransport(gw, job, self.PROMETHEUS_GW_SHARD_LABEL, state=state,
+                                               refresh=self.PROMETHEUS_GW_REFRESH,
+                                               compress=self.PROMETHEUS_GW_COMPRESS)
+
+        for gw in endpoint.split(','):
+            name = dispatcher.add('%s/%s' % (gw, job), __transport__(gw))
+            dispatcher.push(name, self.registry)
+
+        if wait:
+            return dispatcher.wait()
+        return True
     
     def collectMetrics(self):
-        
+        """collect the statistics of the current cluster usage, replacing those of the previous collection"""
+
+        # TODO: make it configurable
+        q_cat = ['matlab','batch','vgl','interact','other']
+
+        ## the nodes and the jobs are probed in parallel; the CPU speed of the nodes is not used
+        probes = ProbeRunner(deadline=self.PROBE_DEADLINE, lv=self.logger.level)
+        probes.add('nodes', NODE_PROPERTIES_CMD, parse_node_properties, default=[])
+        probes.add('jobs' , self.BIN_QSTAT_ALL , parse_qstat_jobs     , default={})
+        r = probes.run()
+
+        ## nodes and jobs indexed by host, job id and queue category
+        snap = ClusterSnapshot( nodes        = r['nodes'],
+                                jobs         = r['jobs'],
+                                categories   = q_cat,
+                                batch_queues = self.TORQUE_BATCH_QUEUES )
+
+        with self.lock:
+            self.clearMetrics()
+            self.updateMetrics(snap)
+
+    def updateMetrics(self, snap):
+        """set the gauges in the registry from the ClusterSnapshot"""
+
         # metrics for core utilisation
-        g_core_usage = Gauge('hpc_stat_core_usage', 'number of used cores per node per queue', ['host', 'queue'], registry=self.registry)
+        g_core_usage = self.getGauge('hpc_stat_core_usage', 'number of used cores per node per queue', ['host', 'queue'])
         
         # metrics for memory utilisation
-        g_mem_usage  = Gauge('hpc_stat_mem_usage' , 'bytes of used memory per node per queue', ['host', 'queue'], registry=self.registry)
+        g_mem_usage  = self.getGauge('hpc_stat_mem_usage' , 'bytes of used memory per node per queue', ['host', 'queue'])
         
         # metrics for node specification
-        g_node_status = Gauge('hpc_stat_node_status', 'node status (-1:down, 0:offline, 1:job-exclusive, 2:free, 3: other)', ['host'], registry=self.registry)
-        g_core_total = Gauge('hpc_stat_core_total', 'number of total cores per node', ['host'], registry=self.registry)
-        g_mem_total  = Gauge('hpc_stat_mem_total' , 'bytes of total memory per node', ['host'], registry=self.registry)
-        g_network_total = Gauge('hpc_stat_network_total' , 'Gbits of network bandwidth', ['host'], registry=self.registry)
-        g_gpu_total  = Gauge('hpc_stat_gpu_total' , 'number of total gpus per node', ['host'], registry=self.registry)
+        g_node_status = self.getGauge('hpc_stat_node_status', 'node status (-1:down, 0:offline, 1:job-exclusive, 2:free, 3: other)', ['host'])
+        g_core_total = self.getGauge('hpc_stat_core_total', 'number of total cores per node', ['host'])
+        g_mem_total  = self.getGauge('hpc_stat_mem_total' , 'bytes of total memory per node', ['host'])
+        g_network_total = self.getGauge('hpc_stat_network_total' , 'Gbits of network bandwidth', ['host'])
+        g_gpu_total  = self.getGauge('hpc_stat_gpu_total' , 'number of total gpus per node', ['host'])
         
         # metrics for job count per queue, per state
-        g_job_count  = Gauge('hpc_stat_job_count' , 'number of jobs' , ['queue','status','host'], registry=self.registry)
-
-        jobs = get_qstat_jobs(s_cmd=self.BIN_QSTAT_ALL)
-        nodes = get_cluster_node_properties()
+        g_job_count  = self.getGauge('hpc_stat_job_count' , 'number of jobs' , ['queue','status','host'])
 
         # TODO: make it more transparent
         n_status = { 'down'          : -1,
@@ -261,22 +633,11 @@ class ClusterStatistics:
                      'free'          :  2,
                      'other'         :  3 }
 
-        # TODO: make it configurable
-        q_cat = ['matlab','batch','vgl','interact','other']
-
-        def _qcat(queue):
-            cat = queue
-
-            if cat in self.TORQUE_BATCH_QUEUES:
-                cat = 'batch'
-            elif queue not in q_cat:
-                cat = 'other'
-
-            return cat
+        q_cat = snap.categories
  
         # static node information
         self.nodes_down = []
-        for n in nodes:
+        for n in snap.nodes:
             g_core_total.labels(host=n.host).set( n.ncores )
             g_mem_total.labels(host=n.host).set( n.mem * 1000000000 )
             g_network_total.labels(host=n.host).set( int(n.net.replace('network','').replace('GigE','')) )
@@ -289,10 +650,6 @@ class ClusterStatistics:
             else:
                 g_node_status.labels(host=n.host).set( n_status['other'] )
 
-            # add extra attribute to match the interactive queue names defined in q_cat
-            n.__dict__['interact'] = n.__dict__['interactive']
-            n.__dict__['other']    = True
-
             # set default usage metrics to zero
             for q in q_cat:
                 g_core_usage.labels(queue=q, host=n.host).set( 0 )
@@ -307,50 +664,43 @@ class ClusterStatistics:
         #     T  - Job is being moved to new location.
         #     W  - Job is waiting for its execution time (-a option) to be reached.
         #     S  - (Unicos only) job is suspended.        
-        
-        ## get jobs in queue or waiting state
-        _jobs = []
-        map(_jobs.extend, jobs.values())
-
-        q_jobs = filter(lambda j:j.jstat in ['Q','S'], _jobs)
-        h_jobs = filter(lambda j:j.jstat in ['H'], _jobs)
 
         # set default job count metrics to zero
         for q in q_cat:
             for s in ['queued','held','running']:
                 if s == 'running':
                     # loop over hosts to set initial value of zero for accepted queues
-                    for n in filter(lambda x:x.__dict__[q], nodes):
+                    for n in snap.nodes_accepting(q):
                         g_job_count.labels(queue=q, status=s, host=n.host).set(0)
                 else:
                     g_job_count.labels(queue=q, status=s, host='na').set(0)
 
-        for j in q_jobs:
-            g_job_count.labels(queue=_qcat(j.queue), status='queued', host='na').inc(1)
+        ## get jobs in queue or waiting state
+        for j in snap.jobs_in(['Q','S']):
+            g_job_count.labels(queue=snap.category(j.queue), status='queued', host='na').inc(1)
             
-        for j in h_jobs:
-            g_job_count.labels(queue=_qcat(j.queue), status='held', host='na').inc(1)
+        for j in snap.jobs_in(['H']):
+            g_job_count.labels(queue=snap.category(j.queue), status='held', host='na').inc(1)
 
         ## get jobs in running state
-        r_jobs = filter(lambda j:j.jstat in ['E','R'], _jobs)
-        for j in r_jobs:
+        for j in snap.jobs_in(['E','R']):
             if j.node:
+                q = snap.category(j.queue)
+
                 # job is counted to the leading host (i.e. the first node on the job property)
-                g_job_count.labels(queue=_qcat(j.queue), status='running', host=j.node[0]).inc(1)
+                g_job_count.labels(queue=q, status='running', host=j.node[0]).inc(1)
              
                 # update core and memory usage
                 m_chunk = 1.0 * j.rmem * 1000000000 / len(j.node)
                 for n in j.node:
-                    # find node in the pbsnode list
-                    ninfo = filter(lambda x:x.host == n, nodes)
-                    if len(ninfo) == 1:
-                        j_core_ids = ninfo[0].jobs[j.jid]
-                        g_core_usage.labels(queue=_qcat(j.queue), host=n).inc(len(j_core_ids))
-                        g_mem_usage.labels(queue=_qcat(j.queue), host=n).inc(m_chunk)
+                    j_core_ids = snap.allocated_cores(n, j.jid)
+                    if j_core_ids is not None:
+                        g_core_usage.labels(queue=q, host=n).inc(len(j_core_ids))
+                        g_mem_usage.labels(queue=q, host=n).inc(m_chunk)
                     else:
-                        logger.warning('job not found on node: %s, %s' % (j.jid, n))
+                        self.logger.warning('job not found on node: %s, %s' % (j.jid, n))
             else:
-                logger.warning('job running/exiting on unknown node: %s [%s]' % (j.jid, j.jstat))
+                self.logger.warning('job running/exiting on unknown node: %s [%s]' % (j.jid, j.jstat))
                 
         return
 
@@ -366,19 +716,25 @@ class ClusterEnergyConsumption(ClusterStatistics):
         self.CFG_XYMONQ = c.get('MetricsPusher', 'CFG_XYMONQ')
         self.XYMON_PDU_LIST = c.get('MetricsPusher', 'XYMON_PDU_LIST').split(',')
 
-    def collectMetrics(self):
-
-        s = Shell(debug=False)
+        self.shell = Shell(debug=False)
 
-        g_energy_usage  = Gauge('hpc_energy_usage' , 'energy consumption watts', ['pdu'], registry=self.registry)
+    def collectMetrics(self):
+        """collect the current energy consumption of the PDUs, replacing that of the previous collection"""
 
+        watts = {}
         for pdu in self.XYMON_PDU_LIST:
             cmd = "%s -c %s -q xymondlog -H %s -T watts | grep 'DevicePowerWatts' | awk '{print $NF}'" % (self.BIN_XYMONQ, self.CFG_XYMONQ, pdu)
-            rc, output, m = s.cmd1(cmd, allowed_exit=[0,255], timeout=300)
+            rc, output, m = self.shell.cmd1(cmd, allowed_exit=[0,255], timeout=300)
             if rc == 0:
-                g_energy_usage.labels(pdu=pdu).set(float(output))
+                watts[pdu] = float(output)
             else:
-                logger.warn('Cannot retrieve energy consumption for %s', pdu)
+                self.logger.warning('Cannot retrieve energy consumption for %s', pdu)
+
+        with self.lock:
+            self.clearMetrics()
+            g_energy_usage = self.getGauge('hpc_energy_usage' , 'energy consumption watts', ['pdu'])
+            for pdu, w in watts.iteritems():
+                g_energy_usage.labels(pdu=pdu).set(w)
 
         return
         
@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+import os
+import time
+import json
+import threading
+import logging
+import Queue
+
+from Common import getMyLogger, getOpenTSDBPusher
+
+import potsdb
+from prometheus_client import push_to_gateway, push_shards_to_gateway, pushed_shards_of_gateway
+from prometheus_client.exposition import default_handler, KeepAliveHandler
+
+## item marking the end of the items pushed to an endpoint
+_END = object()
+
+class OpenTSDBHTTPTransport:
+    '''transport of data points to the OpenTSDB HTTP API by an OpenTSDBPusher
+
+       The items are data points, or lists of data points, as accepted by OpenTSDBPusher.push.
+    '''
+    def __init__(self, pusher):
+        self.pusher = pusher
+
+    def open(self):
+        pass
+
+    def send(self, item, timeout=None):
+        self.pusher.push(item)
+
+    def close(self, timeout=None):
+        self.pusher.close()
+        return self.pusher.nfailed == 0
+
+    def abort(self):
+        self.pusher.close_handle()
+
+class OpenTSDBTelnetTransport:
+    '''transport of data points to OpenTSDB by the telnet put protocol of potsdb
+
+       The items are lists of (metric, value, tags) tuples.  The potsdb.Client is created with
+       the given arguments when the transport is opened.
+    '''
+    def __init__(self, host, **kwargs):
+        self.host   = host
+        self.kwargs = kwargs
+        self.client = None
+
+    def open(self):
+        self.client = potsdb.Client(self.host, **self.kwargs)
+
+    def send(self, item, timeout=None):
+        for m, v, tags in item:
+            self.client.send(m, v, **tags)
+
+    def close(self, timeout=None):
+        return self.client.wait(timeout)
+
+    def abort(self):
+        if self.client is not None:
+            self.client.stop()
+
+class PushgatewayTransport:
+    '''transport of prometheus metrics to a Pushgateway
+
+       The items are CollectorRegistry objects, each of them replaces the metrics of the job
+       (and grouping key) on the gateway.
+    '''
+    def __init__(self, gateway, job, grouping_key=None, handler=default_handler, compress=False):
+        self.gateway      = gateway
+        self.job          = job
+        self.grouping_key = grouping_key
+        self.handler      = handler
+        self.compress     = compress
+
+    def open(self):
+        pass
+
+    def send(self, item, timeout=None):
+        push_to_gateway(self.gateway, job=self.job, registry=item, grouping_key=self.grouping_key,
+                        timeout=timeout, handler=self.handler, compress=self.compress)
+
+    def close(self, timeout=None):
+        return True
+
+    def abort(self):
+        pass
+
+class ShardedPushgatewayTransport:
+    '''transport of prometheus metrics to a Pushgateway, in one group per value of a label
+
+       The items are CollectorRegistry objects.  The series of an item are split by the value of
+       the label (e.g. per host), and only the shards that changed since they were last pushed, or
+       are missing on the gateway (e.g. restarted since), are sent over one persistent connection;
+       see prometheus_client.push_shards_to_gateway.
+
+       The digests of the shards last pushed are kept in the state file, if given, for the next
+       push.  All shards are pushed again if they have not all been pushed for refresh seconds.
+    '''
+    def __init__(self, gateway, job, label, state=None, refresh=3600, grouping_key=None, compress=False):
+        self.gateway      = gateway
+        self.job          = job
+        self.label        = label
+        self.state        = state
+        self.refresh      = refresh
+        self.grouping_key = grouping_key
+        self.compress     = compress
+        self.handler      = None
+        self.digests      = {}
+        self.tfull        = time.time()
+
+        self.logger = getMyLogger(self.__class__.__name__)
+
+    def open(self):
+        self.handler = KeepAliveHandler()
+        if not self.state:
+            return
+        sdir = os.path.dirname(self.state)
+        if sdir and not os.path.isdir(sdir):
+            os.makedirs(sdir)
+        try:
+            f = open(self.state, 'r')
+            try:
+                state = json.load(f)
+            finally:
+                f.close()
+        except IOError, e:
+            self.logger.warning('cannot load state file %s: %s' % (self.state, e))
+            return
+        except ValueError, e:
+            self.logger.error('corrupted state file %s: %s' % (self.state, e))
+            return
+
+        if time.time() - state['time'] < self.refresh:
+            self.digests = state['digests']
+            self.tfull   = state['time']
+
+    def _save(self):
+        if not self.state:
+            return
+        ## write to a temporary file first, not to leave a partial state behind
+        fpath = self.state + '.tmp'
+        f = open(fpath, 'w')
+        try:
+            json.dump({'time': self.tfull, 'digests': self.digests}, f)
+        finally:
+            f.close()
+        os.rename(fpath, self.state)
+
+    def send(self, item, timeout=None):
+        if time.time() - self.tfull >= self.refresh:
+            self.digests = {}
+        full = not self.digests
+        present = None
+        if not full:
+            ## the groups on the gateway, the ones lost by a restart of the gateway are pushed again
+            present = pushed_shards_of_gateway(self.gateway, self.job, self.label,
+                                               grouping_key=self.grouping_key, timeout=timeout)
+        try:
+            n = push_shards_to_gateway(self.gateway, self.job, item, self.label, self.digests,
+                                       grouping_key=self.grouping_key, timeout=timeout,
+                                       handler=self.handler, compress=self.compress, present=present)
+            if full:
+                self.tfull = time.time()
+            self.logger.debug('%d shards of %d pushed or deleted' % (n, len(self.digests)))
+        finally:
+            ## the digests of the shards pushed before a failure are kept as well
+            self._save()
+
+    def close(self, timeout=None):
+        self.handler.close()
+        return True
+
+    def abort(self):
+        if self.handler is not None:
+            self.handler.close()
+
+class PushEndpoint:
+    '''state of the pushing to one endpoint of a PushDispatcher'''
+    def __init__(self, name, transport, qsize, done):
+        self.name      = name
+        self.transport = transport
+        self.done      = done
+        self.queue     = Queue.Queue(qsize)
+        self.thread    = None
+        self.nitems    = 0
+        self.ndropped  = 0
+        self.ok        = False
+        self.error     = None
+        self.finished  = False
+
+class PushDispatcher:
+    '''pushes metrics to several endpoints concurrently, within one overall deadline
+
+       Every endpoint added has a transport (see OpenTSDBHTTPTransport, OpenTSDBTelnetTransport,
+       PushgatewayTransport and ShardedPushgatewayTransport) and a worker thread sending the items
+       pushed to the endpoint, in order.  At most concurrency transports are opened, sending or
+       closing at the same time.
+       The items for an endpoint wait in a queue of qsize items; push blocks while the queue is
+       full, so that the collection of metrics does not run ahead of a slow endpoint.
+
+       Call wait() after the last push.  The pushing stops deadline seconds after the dispatcher
+       is created; the items not sent by then are dropped.
+    '''
+    def __init__(self, deadline=None, concurrency=4, qsize=1000, lv=logging.ERROR):
+
+        self.logger = getMyLogger(self.__class__.__name__)
+        self.logger.setLevel(lv)
+
+        self.deadline = None
+        if deadline:
+            self.deadline = time.time() + deadline
+
+        self.qsize = qsize
+
+        self._slots     = threading.Semaphore(max(1, concurrency))
+        self._lock      = threading.Lock()
+        self._endpoints = []
+
+    def _remaining(self):
+        '''seconds left before the deadline, None if there is no deadline'''
+        if self.deadline is None:
+            return None
+        return max(0, self.deadline - time.time())
+
+    def _expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def _put(self, ep, item):
+        '''put an item in the queue of the endpoint, returns False if the endpoint is finished
+           or the deadline has passed before there is space in the queue'''
+        while not ep.finished:
+            try:
+                ep.queue.put(item, True, 1)
+                return True
+            except Queue.Full:
+                if self._expired():
+                    break
+        return False
+
+    def _drop(self, ep):
+        '''drop the items left in the queue of the endpoint'''
+        while True:
+            try:
+                item = ep.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if item is not _END:
+                with self._lock:
+                    ep.ndropped += 1
+
+    def _run(self, ep):
+        '''the worker thread of an endpoint'''
+        t = ep.transport
+        item = None
+        try:
+            with self._slots:
+                t.open()
+            while True:
+                item = ep.queue.get()
+                if item is _END:
+                    break
+                if self._expired():
+                    raise RuntimeError('deadline passed')
+                with self._slots:
+                    t.send(item, self._remaining())
+                ep.nitems += 1
+                item = None
+            with self._slots:
+                ep.ok = t.close(self._remaining()) and ep.ndropped == 0
+        except Exception, e:
+            if item is not None and item is not _END:
+                with self._lock:
+                    ep.ndropped += 1
+            ep.error = e
+            self.logger.error('cannot push to %s: %s' % (ep.name, e))
+            try:
+                t.abort()
+            except Exception, e:
+                self.logger.debug('cannot abort push to %s: %s' % (ep.name, e))
+        finally:
+            ep.finished = True
+            self._drop(ep)
+
+        if ep.done is not None:
+            try:
+                ep.done(ep.ok)
+            except Exception, e:
+                self.logger.error('push to %s done, but the callback failed: %s' % (ep.name, e))
+
+    def add(self, name, transport, done=None):
+        '''add an endpoint, returns its name.  The done callback is called in the worker thread,
+           with True if all items have been pushed to the endpoint, once the pushing is over.'''
+
+        if name in [ep.name for ep in self._endpoints]:
+            raise ValueError('endpoint already added: %s' % name)
+
+        ep = PushEndpoint(name, transport, self.qsize, done)
+        ep.thread = threading.Thread(target=self._run, args=(ep,), name='push %s' % name)
+        ep.thread.daemon = True
+        self._endpoints.append(ep)
+        ep.thread.start()
+        return name
+
+    def push(self, name, item):
+        '''push an item to the endpoint, returns False if the item is dropped'''
+        ep = [x for x in self._endpoints if x.name == name][0]
+        if not self._put(ep, item):
+            with self._lock:
+                ep.ndropped += 1
+            return False
+        return True
+
+    def broadcast(self, item, names=None):
+        '''push an item to the named endpoints, by default all endpoints; returns False if the item
+           is dropped for any of them'''
+        if names is None:
+            names = [ep.name for ep in self._endpoints]
+        ok = True
+        for name in names:
+            ok = self.push(name, item) and ok
+        return ok
+
+    def wait(self):
+        '''wait until all items are pushed, or the deadline passes.  Returns True if all items
+           have been pushed to all endpoints.'''
+
+        for ep in self._endpoints:
+            self._put(ep, _END)
+
+        for ep in self._endpoints:
+            ep.thread.join(self._remaining())
+
+        ok = True
+        for ep in self._endpoints:
+            if ep.thread.is_alive():
+                self.logger.error('push to %s not finished before the deadline' % ep.name)
+                ep.transport.abort()
+                ok = False
+                continue
+
+            self._drop(ep)
+            self.logger.info('%d items pushed to %s, %d dropped' % (ep.nitems, ep.name, ep.ndropped))
+            ok = ok and ep.ok and ep.ndropped == 0
+
+        return ok
+
+def getPushDispatcher(cfg, lv=logging.ERROR):
+    '''create the PushDispatcher with the PUSH_DEADLINE and PUSH_CONCURRENCY in the [MetricsPusher] section of the config'''
+    return PushDispatcher( deadline    = cfg.getfloat('MetricsPusher','PUSH_DEADLINE'),
+                           concurrency = cfg.getint('MetricsPusher','PUSH_CONCURRENCY'),
+                           lv          = lv )
+
+def addOpenTSDBEndpoints(dispatcher, cfg):
+    '''add an OpenTSDBHTTPTransport to the dispatcher for each of the comma-separated URLs in URL_PUSH
+       of the [OpenTSDB] section of the config, returns the names of the endpoints'''
+    return [ dispatcher.add(url, OpenTSDBHTTPTransport(getOpenTSDBPusher(cfg, url)))
+             for url in cfg.get('OpenTSDB','URL_PUSH').split(',') if url ]
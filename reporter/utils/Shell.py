@@ -21,6 +21,12 @@
 # 
 #     rc,output,m=shell.cmd1('edg-get-job-status -all')
 #
+# Output is returned line by line while the command runs
+#
+#     c=shell.lines('edg-get-job-status -all')
+#     for l in c: ...
+#     rc=c.wait()
+#
 # Output is not captured. Useful for commands that require interactions
 #
 #     rc=shell.system('grid-proxy-init')
@@ -32,7 +38,7 @@
 #
 #     fullpath=shell.wrapper('lcg-cp')
 
-import os, re, tempfile, time, signal
+import os, re, tempfile, time, signal, subprocess, threading, select, errno
 
 #import Ganga.Utility.logging
 #logger = Ganga.Utility.logging.getLogger()
@@ -41,6 +47,146 @@ import os, re, tempfile, time, signal
 from utils.Common import *
 logger = getMyLogger(__name__)
 
+class ShellCommand:
+   """An OS command run by /bin/sh, with the stderr and stdout merged into a pipe.
+
+   Iterating over the object gives the lines of the output as the command writes them, read
+   gives the whole output at once. The exit status (negative if the command is killed by a
+   signal) is in the rc attribute after wait is called; found is False if the command fails
+   and the shell reports the command is not found.
+
+   The command is sent a SIGTERM after timeout seconds, and a SIGKILL if it has not stopped 5
+   seconds later. The signals go to the process group of the shell, so that the children of the
+   shell stop writing to the pipe as well. The pipe is abandoned once the SIGKILL is sent, so
+   that a process that left the process group and still holds the pipe does not block the
+   reading of the output.
+   """
+
+   BYTES = 4096
+
+   def __init__(self,cmd,env=None,allowed_exit=[0],timeout=None):
+      self.cmd=cmd
+      self.allowed_exit=allowed_exit
+      self.timeout=timeout
+      self.rc=None
+      self.found=True
+      self.head=[]
+      self.nhead=0
+      self.proc=None
+      self.timer=None
+      self.killed=False
+      self._notfound=False
+      self._tail=''
+      self._lock=threading.Lock()
+
+      logger.debug('Running shell command: %s' % cmd)
+      try:
+         self.proc = subprocess.Popen(['/bin/sh','-c',cmd],stdout=subprocess.PIPE,
+                                      stderr=subprocess.STDOUT,env=env,close_fds=True,
+                                      preexec_fn=os.setsid)
+      except OSError, (num,text):
+         logger.warning( 'Problem with shell command: %s, %s', num,text)
+         self.rc = 255
+         return
+
+      ## the reading of the output is woken up by the SIGKILL through this pipe
+      self._wake = os.pipe()
+
+      if timeout:
+         self.timer = threading.Timer(timeout,self._kill,(signal.SIGTERM,))
+         self.timer.daemon = True
+         self.timer.start()
+
+   def _kill(self,sig):
+      "the timer killing the command, a SIGTERM is followed by a SIGKILL 5 seconds later"
+      with self._lock:
+         if self.rc is None:
+            self._signal(sig)
+
+   def _signal(self,sig):
+      if sig == signal.SIGTERM:
+         logger.warning('Command interrupted - timeout %ss reached: %s', self.timeout,self.cmd)
+         self.timer = threading.Timer(5,self._kill,(signal.SIGKILL,)) # wait just 5 seconds before killing with SIGKILL
+         self.timer.daemon = True
+         self.timer.start()
+      logger.debug('killing process %d with signal %d',self.proc.pid,sig)
+      try:
+         os.killpg(self.proc.pid,sig)
+      except OSError:
+         pass
+      if sig == signal.SIGKILL:
+         self.killed = True
+         try:
+            os.write(self._wake[1],'x')
+         except OSError:
+            pass
+
+   def _chunks(self):
+      "the output as the command writes it, until the end of the output or the SIGKILL"
+      if self.proc is None:
+         return
+      fd = self.proc.stdout.fileno()
+      while not self.killed:
+         try:
+            r = select.select([fd,self._wake[0]],[],[])[0]
+            if self._wake[0] in r:
+               break
+            data = os.read(fd,65536)
+         except (select.error, OSError), e:
+            if e.args[0] == errno.EINTR:
+               continue
+            raise
+         if not data:
+            break
+         if self.nhead < self.BYTES:
+            self.head.append(data[:self.BYTES-self.nhead])
+            self.nhead += len(self.head[-1])
+#FIXME /bin/sh might have also other error messages
+         if 'command not found\n' in self._tail + data:
+            self._notfound = True
+         self._tail = data[-17:]
+         yield data
+
+   def __iter__(self):
+      rest = ''
+      for data in self._chunks():
+         lines = (rest + data).split('\n')
+         rest = lines.pop()
+         for l in lines:
+            yield l + '\n'
+      if rest:
+         yield rest
+
+   def read(self):
+      "Returns the whole output of the command, read at once rather than line by line"
+      return ''.join(self._chunks())
+
+   def wait(self):
+      "Wait for the command to finish, the output not consumed is discarded. Returns the exit status"
+      if self.rc is not None:
+         return self.rc
+
+      for data in self._chunks():
+         pass
+      rc = self.proc.wait()
+      with self._lock:
+         self.rc = rc
+         if self.timer:
+            self.timer.cancel()
+         self.proc.stdout.close()
+         for fd in self._wake:
+            os.close(fd)
+
+      if self.rc not in self.allowed_exit:
+         logger.warning('exit status [%d] of command %s',self.rc,self.cmd)
+         logger.warning('<first %d bytes of output>\n%s',self.BYTES,''.join(self.head))
+         logger.warning('<end of first %d bytes of output>',self.BYTES)
+      if self.rc != 0 and self._notfound:
+         self.found = False
+         logger.warning('command %s not found',self.cmd)
+
+      return self.rc
+
 class Shell:
 
    #exceptions=getConfig('Shell')['IgnoredVars']
@@ -100,67 +246,39 @@ class Shell:
 
       self.dirname=None
 
+   def lines(self,cmd,allowed_exit=[0],timeout=None):
+      """Execute an OS command and returns a ShellCommand iterating over the lines of the stdout and
+      stderr (merged) while the command runs. The exit status is in the rc attribute of the
+      ShellCommand once the lines are consumed or its wait method is called"""
+
+      return ShellCommand(cmd,self.env,allowed_exit,timeout)
+
    def cmd(self,cmd,soutfile=None,allowed_exit=[0], capture_stderr=False,timeout=None, mention_outputfile_on_errors=True):
       "Execute an OS command and captures the stderr and stdout which are returned in a file"
  
       if not soutfile: soutfile=tempfile.mktemp('.out')
-         
-      logger.debug('Running shell command: %s' % cmd)
+
+      c = ShellCommand(cmd,self.env,allowed_exit,timeout)
+      f = open(soutfile,'w')
       try:
-         t0 = time.time()
-         already_killed = False
-         timeout0 = timeout
-         pid = os.spawnve(os.P_NOWAIT,'/bin/sh',['/bin/sh','-c','%s > %s 2>&1' % (cmd,soutfile)],self.env)         
-         while 1:
-            wpid,sts = os.waitpid(pid,os.WNOHANG)
-            if wpid!=0:
-               if os.WIFSIGNALED(sts):
-                  rc = -os.WTERMSIG(sts)
-                  break
-               elif os.WIFEXITED(sts):
-                  rc = os.WEXITSTATUS(sts)
-                  break
-            if timeout and time.time()-t0>timeout:
-               logger.warning('Command interrupted - timeout %ss reached: %s', timeout0,cmd)
-               if already_killed:
-                  sig = signal.SIGKILL
-               else:
-                  sig = signal.SIGTERM
-               logger.debug('killing process %d with signal %d',pid,sig)
-               os.kill(pid,sig)
-               t0=time.time()
-               timeout = 5 # wait just 5 seconds before killing with SIGKILL
-               already_killed = True
-            time.sleep(0.1)            
+         f.write(c.read())
+      finally:
+         f.close()
+         c.wait()
 
-      except OSError, (num,text):
-         logger.warning( 'Problem with shell command: %s, %s', num,text)
-         rc = 255
-      
-      BYTES = 4096
-      if rc not in allowed_exit:
-         logger.warning('exit status [%d] of command %s',rc,cmd)
-         if mention_outputfile_on_errors:
-            logger.warning('full output is in file: %s',soutfile)
-         logger.warning('<first %d bytes of output>\n%s',BYTES,file(soutfile).read(BYTES))
-         logger.warning('<end of first %d bytes of output>',BYTES)
-         
-#FIXME /bin/sh might have also other error messages                                                                                            
-      m = None
-      if rc != 0:
-         m = re.search('command not found\n',file(soutfile).read())
-         if m: logger.warning('command %s not found',cmd)
-                                                                                                       
-      return rc,soutfile,m is None
+      if c.rc not in allowed_exit and mention_outputfile_on_errors:
+         logger.warning('full output is in file: %s',soutfile)
+
+      return c.rc,soutfile,c.found
 
    def cmd1(self,cmd,allowed_exit=[0],capture_stderr=False,timeout=None):
        "Executes an OS command and captures the stderr and stdout which are returned as a string"
        
-       rc,outfile,m = self.cmd(cmd,None,allowed_exit,capture_stderr,timeout,mention_outputfile_on_errors=False)
-       output=file(outfile).read()
-       os.unlink(outfile)
+       c = ShellCommand(cmd,self.env,allowed_exit,timeout)
+       output = c.read()
+       c.wait()
        
-       return rc,output, m
+       return c.rc,output,c.found
        
    def system(self,cmd,allowed_exit=[0], stderr_file=None):
       """Execute on OS command. Useful for interactive commands. Stdout and Stderr are not